@@ -1,44 +1,46 @@
 #!/usr/bin/env python3
 
+import argparse
+import hashlib
+import json
 import sys
-import textwrap
 
 # Very basic bitstream to SVF converter, tested with the ULX3S WiFi interface
+#
+# Usable from other scripts too (wyrm.py --flash):
+#   from bit_to_flash import bit_to_svf
+#   bit_to_svf("colorlight_5a_75b.bit", "wyrm_flash.svf")
+#
+# Incremental flashing: a manifest records a hash of every 64 KiB sector that was
+# flashed, and sectors whose hash is unchanged are neither erased nor programmed
+# the next time. Save the manifest only once the SVF played back successfully.
+#
+# By default every page program and sector erase is followed by a fixed wait for
+# the datasheet worst case. With poll, the flash status register is read back
+# instead until its busy bit clears, which needs an SVF player that implements
+# the LOOP/ENDLOOP extension used by Lattice's tools. OpenOCD (wyrm.py --flash)
+# does not, so polling is only offered here.
 
 flash_page_size = 256
 erase_block_size = 64*1024
 
-
-def bitreverse(x):
-    y = 0
-    for i in range(8):
-        if (x >> (7 - i)) & 1 == 1:
-            y |= (1 << i)
-    return y
-
-with open(sys.argv[1], 'rb') as bitf:
-    bs = bitf.read()
-    # Autodetect IDCODE from bitstream
-    idcode_cmd = bytes([0xE2, 0x00, 0x00, 0x00])
-    idcode = None
-    for i in range(len(bs) - 4):
-        if bs[i:i+4] == idcode_cmd:
-            idcode = bs[i+4] << 24
-            idcode |= bs[i+5] << 16
-            idcode |= bs[i+6] << 8
-            idcode |= bs[i+7]
-            break
-    if idcode is None:
-        print("Failed to find IDCODE in bitstream, check bitstream is valid")
-        sys.exit(1)
-    print("IDCODE in bitstream is 0x%08x" % idcode)
-    bitf.seek(0)
-
-    address = 0
-    last_page = -1
-
-    with open(sys.argv[2], 'w') as svf:
-        print("""
+# SPI bytes go out LSB first over JTAG: every byte is bit reversed, and SDR wants
+# the whole register as one hex number, so the byte order is reversed as well
+BIT_REVERSE = bytes(int("{:08b}".format(i)[::-1], 2) for i in range(256))
+# Erased flash reads back all ones, pages like that need no programming
+BLANK_PAGE = b"\xff" * flash_page_size
+IDCODE_CMD = bytes([0xE2, 0x00, 0x00, 0x00])
+# Longest SVF line written
+LINE_LENGTH = 100
+
+# Worst case page program and sector erase times, waited for in full without poll
+PAGE_PROGRAM_TIME = 2.5e-2
+SECTOR_ERASE_TIME = 3.0
+# With poll: time between status reads while programming and erasing
+PAGE_POLL_INTERVAL = 1e-4
+SECTOR_POLL_INTERVAL = 1e-2
+
+SVF_HEADER = """
 STATE RESET;
 HDR	0;
 HIR	0;
@@ -47,14 +49,12 @@ TIR	0;
 ENDDR	DRPAUSE;
 ENDIR	IRPAUSE;
 STATE	IDLE;
-        """, file=svf)
-        print("""
+
 SIR	8	TDI  (E0);
 SDR	32	TDI  (00000000)
-        TDO  ({:08X})
+        TDO  ({idcode:08X})
         MASK (FFFFFFFF);
-        """.format(idcode), file=svf)
-        print("""
+
 SIR	8	TDI  (1C);
 SDR	510	TDI  (3FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
              FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF);
@@ -107,35 +107,9 @@ SDR 8    TDI(60);
 SDR 16   TDI(0080);
 RUNTEST 1.00E-0 SEC;
 
+"""
 
-        """, file=svf)
-        while True:
-            if((address // 0x10000) != last_page):
-                last_page = (address // 0x10000)
-                print("""SDR	8	TDI  (60);
-                """, file=svf)
-                address_flipped = [bitreverse(x) for x in [0xd8,int(address // 0x10000),0x00,0x00]]
-                hex_address= ["{:02X}".format(x) for x in reversed(address_flipped)]
-                print("\n".join(textwrap.wrap("SDR {} TDI ({});".format(8*len(hex_address), "".join(hex_address)), 100)), file=svf)
-                print("""RUNTEST	3.00 SEC;
-                """, file=svf)
-
-            chunk = bitf.read(flash_page_size)
-            if not chunk:
-                break
-            # Convert chunk to bit-reversed hex
-            br_chunk = [bitreverse(x) for x in bytes([0x02, int(address / 0x10000 % 0x100),int(address / 0x100 % 0x100),int(address % 0x100)]) + chunk]
-            address += len(chunk)
-            hex_chunk = ["{:02X}".format(x) for x in reversed(br_chunk)]
-            print("""
-SDR	8	TDI  (60);
-                """, file=svf)
-            print("\n".join(textwrap.wrap("SDR {} TDI ({});".format(8*len(br_chunk), "".join(hex_chunk)), 100)), file=svf)
-            print("""
-RUNTEST	2.50E-2 SEC;
-                """, file=svf)
-
-        print("""
+SVF_FOOTER = """
 // BYPASS
 SIR 8 TDI (FF);
 
@@ -147,4 +121,130 @@ STATE IDLE;
 RUNTEST 32 TCK;
 RUNTEST 2.00E-2 SEC;
 STATE RESET;
-        """, file=svf)
+"""
+
+def find_idcode(bs:bytes) -> int:
+    """
+    IDCODE the bitstream was built for, None when there is none.
+    """
+    i = bs.find(IDCODE_CMD)
+    if i < 0 or i + 8 > len(bs):
+        return None
+    return int.from_bytes(bs[i+4:i+8], "big")
+
+def spi_sdr(data:bytes) -> str:
+    """
+    SDR shifting data out to the flash, wrapped at LINE_LENGTH.
+    """
+    line = "SDR {} TDI ({});".format(8*len(data), data.translate(BIT_REVERSE)[::-1].hex().upper())
+    return "\n".join(line[i:i+LINE_LENGTH] for i in range(0, len(line), LINE_LENGTH)) + "\n"
+
+def wait_ready(timeout:float, interval:float, poll:bool) -> str:
+    """
+    Wait for a program or erase to finish: timeout seconds, or with poll read
+    status (05h) every interval seconds until busy (bit 0) clears, giving up and
+    failing the playback after timeout.
+    """
+    if not poll:
+        return "RUNTEST\t{:.2E} SEC;\n\n".format(timeout)
+    # Status comes back bit reversed in the second byte, busy ends up in the top bit
+    return ("LOOP {};\n"
+        "RUNTEST\t{:.2E} SEC;\n"
+        "SDR\t16\tTDI  (00A0)\n"
+        "        TDO  (0000)\n"
+        "        MASK (8000);\n"
+        "ENDLOOP;\n\n").format(max(1, round(timeout/interval)), interval)
+
+def sector_hashes(bs:bytes) -> list:
+    """
+    SHA-256 of every erase sector, as the flash holds it: padded with 0xFF.
+    """
+    return [hashlib.sha256(bs[i:i + erase_block_size].ljust(erase_block_size, b"\xff")).hexdigest()
+        for i in range(0, len(bs), erase_block_size)]
+
+def load_manifest(path:str, idcode:int) -> list:
+    """
+    Sector hashes from the last successful flash, None when unknown or for another FPGA.
+    """
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("idcode") != idcode or manifest.get("sector_size") != erase_block_size:
+        return None
+    return manifest.get("sectors")
+
+def save_manifest(path:str, result:dict) -> None:
+    with open(path, "w") as f:
+        json.dump({"idcode": result["idcode"], "sector_size": erase_block_size, "sectors": result["hashes"]}, f, indent=1)
+
+def bit_to_svf(bit_path:str, svf_path:str, skip_blank:bool = True, manifest:str = None, poll:bool = False) -> dict:
+    """
+    Write an SVF that erases the flash sectors covered by the bitstream and
+    programs it page by page. With skip_blank, pages that are all 0xFF are left
+    as the erase left them. Sectors whose hash matches the one in the manifest
+    of the last successful flash, when given, are skipped altogether. poll
+    selects status polling over fixed waits, see wait_ready().
+
+    Returns the idcode, the sector hashes for save_manifest and sector and page counts.
+    """
+    with open(bit_path, "rb") as bitf:
+        bs = bitf.read()
+    # Autodetect IDCODE from bitstream
+    idcode = find_idcode(bs)
+    if idcode is None:
+        raise ValueError("Failed to find IDCODE in bitstream, check bitstream is valid")
+
+    hashes = sector_hashes(bs)
+    previous = (load_manifest(manifest, idcode) if manifest else None) or []
+    sectors = unchanged = pages = skipped = 0
+    with open(svf_path, "w", buffering=1 << 20) as svf:
+        svf.write(SVF_HEADER.format(idcode=idcode))
+        for sector, start in enumerate(range(0, len(bs), erase_block_size)):
+            if sector < len(previous) and previous[sector] == hashes[sector]:
+                unchanged += 1
+                continue
+            sectors += 1
+            # Write enable, then erase the 64 KiB sector
+            svf.write("SDR\t8\tTDI  (60);\n")
+            svf.write(spi_sdr(bytes([0xd8, sector, 0x00, 0x00])))
+            svf.write(wait_ready(SECTOR_ERASE_TIME, SECTOR_POLL_INTERVAL, poll))
+
+            for address in range(start, min(start + erase_block_size, len(bs)), flash_page_size):
+                chunk = bs[address:address + flash_page_size]
+                if skip_blank and chunk == BLANK_PAGE[:len(chunk)]:
+                    skipped += 1
+                    continue
+                # Write enable, then page program
+                svf.write("SDR\t8\tTDI  (60);\n")
+                svf.write(spi_sdr(bytes([0x02, (address >> 16) & 0xff, (address >> 8) & 0xff, address & 0xff]) + chunk))
+                svf.write(wait_ready(PAGE_PROGRAM_TIME, PAGE_POLL_INTERVAL, poll))
+                pages += 1
+        svf.write(SVF_FOOTER)
+    return {"idcode": idcode, "hashes": hashes, "sectors": sectors, "unchanged": unchanged,
+        "pages": pages, "skipped": skipped}
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert an ECP5 bitstream to an SVF programming the SPI flash.")
+    parser.add_argument("bitstream",                           help="Bitstream (.bit) to flash.")
+    parser.add_argument("svf",                                 help="SVF file to write.")
+    parser.add_argument("--manifest",      default=None,       help="Manifest of the last successful flash: unchanged sectors are skipped.")
+    parser.add_argument("--full",          action="store_true", help="Ignore the manifest and write every sector.")
+    parser.add_argument("--save-manifest", default=None,       help="Write this bitstream's manifest here, for once it is flashed.")
+    parser.add_argument("--poll",          action="store_true", help="Poll the flash busy bit instead of fixed waits (needs a player with SVF LOOP, not OpenOCD).")
+    args = parser.parse_args()
+
+    try:
+        result = bit_to_svf(args.bitstream, args.svf, manifest=None if args.full else args.manifest, poll=args.poll)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    print("IDCODE in bitstream is 0x%08x" % result["idcode"])
+    print("{} sectors to write, {} unchanged; {} pages to program, {} blank pages skipped".format(
+        result["sectors"], result["unchanged"], result["pages"], result["skipped"]))
+    if args.save_manifest:
+        save_manifest(args.save_manifest, result)
+
+if __name__ == "__main__":
+    main()
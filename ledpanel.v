@@ -17,6 +17,8 @@ module ledpanel (
     input wire ctrl_en,
     input wire [15:0] ctrl_addr,        // Addr to write color info on [col_info][row_info]
     input wire [23:0] ctrl_wdat,        // Data to be written [R][G][B]
+    input wire ctrl_swap,               // Show what was written so far from the next refresh on
+    output wire ctrl_swap_busy,         // A swap is waiting for the current refresh to end
 
     input wire display_clock,
     output reg panel_r0, panel_g0, panel_b0, panel_r1, panel_g1, panel_b1,
@@ -26,12 +28,15 @@ module ledpanel (
 parameter integer INPUT_DEPTH          = 6;    // bits of color before gamma correction
 parameter integer COLOR_DEPTH          = 6;    // bits of color after gamma correction
 parameter integer CHAINED              = 1; // number of panels in chain
+parameter integer DOUBLE_BUFFER        = 0; // write to a back buffer, shown on ctrl_swap
 
 localparam integer SIZE_BITS = $clog2(CHAINED);
+localparam integer BANK_SIZE = CHAINED*4096;
+localparam integer BANKS     = DOUBLE_BUFFER ? 2 : 1;
 
-reg [COLOR_DEPTH-1:0] video_mem_r [0:CHAINED*4096-1];
-reg [COLOR_DEPTH-1:0] video_mem_g [0:CHAINED*4096-1];
-reg [COLOR_DEPTH-1:0] video_mem_b [0:CHAINED*4096-1];
+reg [COLOR_DEPTH-1:0] video_mem_r [0:BANKS*BANK_SIZE-1];
+reg [COLOR_DEPTH-1:0] video_mem_g [0:BANKS*BANK_SIZE-1];
+reg [COLOR_DEPTH-1:0] video_mem_b [0:BANKS*BANK_SIZE-1];
 
 reg [COLOR_DEPTH-1:0] gamma_mem   [0:2**COLOR_DEPTH-1];
 
@@ -49,10 +54,27 @@ initial begin:video_mem_init
     $readmemh("blue.mem",video_mem_b);
 end
 
+// Double buffering: the write side flips to the other bank as soon as a swap is
+// requested, the display side follows at the end of the refresh in progress.
+// Until then ctrl_swap_busy is set and nothing should be written.
+reg write_bank = DOUBLE_BUFFER ? 1 : 0;   // ctrl_clk domain
+reg front_bank = 0;                       // display_clock domain
+reg [1:0] front_bank_ctrl = 0;
+reg [1:0] write_bank_display = 0;
+
 always @(posedge ctrl_clk) begin
-    if (ctrl_en) video_mem_r[ctrl_addr] <= ctrl_wdat[16+INPUT_DEPTH-1:16];
-    if (ctrl_en) video_mem_g[ctrl_addr] <= ctrl_wdat[8+INPUT_DEPTH-1:8];
-    if (ctrl_en) video_mem_b[ctrl_addr] <= ctrl_wdat[0+INPUT_DEPTH-1:0];
+    if (DOUBLE_BUFFER && ctrl_swap) write_bank <= !write_bank;
+    front_bank_ctrl <= {front_bank_ctrl[0], front_bank};
+end
+
+assign ctrl_swap_busy = DOUBLE_BUFFER && (front_bank_ctrl[1] == write_bank);
+
+wire [16+BANKS-1:0] write_index = ctrl_addr + (write_bank ? BANK_SIZE : 0);
+
+always @(posedge ctrl_clk) begin
+    if (ctrl_en) video_mem_r[write_index] <= ctrl_wdat[16+INPUT_DEPTH-1:16];
+    if (ctrl_en) video_mem_g[write_index] <= ctrl_wdat[8+INPUT_DEPTH-1:8];
+    if (ctrl_en) video_mem_b[write_index] <= ctrl_wdat[0+INPUT_DEPTH-1:0];
 end
 
 reg [5+COLOR_DEPTH+SIZE_BITS:0] cnt_x = 0;
@@ -81,6 +103,7 @@ always @(posedge display_clock) begin
 end
 
 always @(posedge display_clock) begin
+    write_bank_display <= {write_bank_display[0], write_bank};
     state <= !state;
     if (!state) begin
         if (cnt_x > max_cnt_x) begin
@@ -89,6 +112,8 @@ always @(posedge display_clock) begin
             if (cnt_z == COLOR_DEPTH-1) begin
                 cnt_y <= cnt_y + 1;
                 cnt_z <= 0;
+                // Last row of the refresh done: show the bank not being written
+                if (DOUBLE_BUFFER && cnt_y == 31) front_bank <= !write_bank_display[1];
             end
         end else begin
             cnt_x <= cnt_x + 1;
@@ -113,10 +138,12 @@ always @(posedge display_clock) begin
     addr_z <= cnt_z;
 end
 
+wire [16+BANKS-1:0] read_index = {addr_y, addr_x} + (front_bank ? BANK_SIZE : 0);
+
 always @(posedge display_clock) begin
-    data_rgb[2] <= gamma_mem[video_mem_r[{addr_y, addr_x}]][addr_z];
-    data_rgb[1] <= gamma_mem[video_mem_g[{addr_y, addr_x}]][addr_z];
-    data_rgb[0] <= gamma_mem[video_mem_b[{addr_y, addr_x}]][addr_z];
+    data_rgb[2] <= gamma_mem[video_mem_r[read_index]][addr_z];
+    data_rgb[1] <= gamma_mem[video_mem_g[read_index]][addr_z];
+    data_rgb[0] <= gamma_mem[video_mem_b[read_index]][addr_z];
 end
 
 always @(posedge display_clock) begin
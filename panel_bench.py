@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+
+# Sender benchmarks: runs the per-frame path of every sender script against a
+# loopback UDP sink and reports encode time per frame, packet rate and the
+# frame rate achieved end to end with pacing off (or as set by --pps/--bps).
+#
+# Every case runs --repeat times, each run for at least --frames frames and
+# --min-time seconds, and reports the best run. Runs of different cases take
+# turns, so a slow spell of the machine does not hit all runs of one case. The spread of the runs is
+# saved with a baseline, and a comparison only counts changes beyond the
+# threshold and beyond the spread of either side as regressions.
+#
+# Content is synthetic and written to real files first (PNG, GIF, MJPEG AVI),
+# so loading, decoding and scaling are part of the measurement:
+#   noise     .. new random pixels every frame, the worst case for every encoder
+#   static    .. the same frame over and over, the best case for --delta
+#   letterbox .. 16:9 noise scaled into the wall, with black bars
+#
+#   ./panel_bench.py --save baseline.json
+#   ./panel_bench.py --compare baseline.json --threshold 0.1
+
+import argparse
+import json
+import os
+import platform
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from panel_encoder import FrameEncoder, PanelLayout, add_encoder_arguments, encoder_from_args
+from panel_pipeline import FramePipeline, PresentationClock, add_pipeline_arguments
+from panel_sources import VideoSource, load_gif
+from panel_transport import add_transport_arguments, transport_from_args
+
+SENDERS = ("send_img", "send_gif", "send_gif_128", "send_vid_128", "send_vid_vectorized")
+CONTENTS = ("noise", "static", "letterbox")
+# Metrics compared against a baseline, and whether larger is better
+METRICS = {
+    "encode_us"         : False,
+    "fps"               : True,
+    "packets_per_frame" : False,
+}
+
+# Loopback sink ------------------------------------------------------------------------------------
+
+class LoopbackSink:
+    """
+    Counts the datagrams arriving on an ephemeral localhost port, on a thread.
+    """
+    def __init__(self) -> None:
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 << 20)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.settimeout(0.05)
+        self.address = self.sock.getsockname()
+        self.packets = 0
+        self.bytes = 0
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="sink", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        buf = bytearray(65536)
+        while self._running:
+            try:
+                nbytes = self.sock.recv_into(buf)
+            except socket.timeout:
+                continue
+            self.packets += 1
+            self.bytes += nbytes
+
+    def drain(self, packets:int, timeout:float = 1.0) -> None:
+        """
+        Give datagrams still in flight up to timeout seconds to arrive.
+        """
+        end = time.monotonic() + timeout
+        while self.packets < packets and time.monotonic() < end:
+            time.sleep(0.01)
+
+    def close(self) -> None:
+        self._running = False
+        self._thread.join()
+        self.sock.close()
+
+# Content ------------------------------------------------------------------------------------------
+
+def synthetic_frames(content:str, size:tuple, count:int, seed:int = 0) -> np.ndarray:
+    """
+    count RGB frames of size = (width, height) (16:9 at the same width for letterbox).
+    """
+    width, height = size
+    if content == "letterbox":
+        height = width*9//16
+    rng = np.random.default_rng(seed)
+    if content == "static":
+        return np.repeat(rng.integers(0, 256, (1, height, width, 3), dtype=np.uint8), count, axis=0)
+    return rng.integers(0, 256, (count, height, width, 3), dtype=np.uint8)
+
+def write_images(frames:np.ndarray, directory:str) -> list:
+    from PIL import Image
+    paths = []
+    for i, frame in enumerate(frames):
+        paths.append(os.path.join(directory, f"frame{i}.png"))
+        Image.fromarray(frame).save(paths[-1])
+    return paths
+
+def write_gif(frames:np.ndarray, path:str) -> str:
+    from PIL import Image
+    images = [Image.fromarray(frame) for frame in frames]
+    images[0].save(path, save_all=True, append_images=images[1:], duration=0, loop=0)
+    return path
+
+def write_video(frames:np.ndarray, path:str) -> str:
+    import cv2
+    height, width = frames.shape[1:3]
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 30, (width, height))
+    if not writer.isOpened():
+        raise RuntimeError("OpenCV can't write MJPEG video here")
+    for frame in frames:
+        writer.write(frame[..., ::-1])
+    writer.release()
+    return path
+
+# Sender paths -------------------------------------------------------------------------------------
+
+class FreeRunningClock(PresentationClock):
+    """
+    Never waits and never drops, so the pipeline runs as fast as its slowest stage.
+    """
+    def __init__(self) -> None:
+        super().__init__(0.0)
+
+    def is_past(self, index:int) -> bool:
+        return False
+
+    def wait(self, index:int) -> None:
+        self.on_time += 1
+
+def median_us(times:list) -> float:
+    return float(np.median(times))*1e6
+
+def run_for(args, step) -> tuple:
+    """
+    Call step(i) for i = 0, 1, ... until at least args.frames frames and
+    args.min_time seconds have gone by. Returns (frames, elapsed seconds).
+    """
+    frames = 0
+    start = time.perf_counter()
+    while frames < args.frames or time.perf_counter() - start < args.min_time:
+        step(frames)
+        frames += 1
+    return frames, time.perf_counter() - start
+
+def time_calls(function, items:list, count:int = 0) -> list:
+    # One untimed call first, the first one pays for page faults and caches
+    function(items[0])
+    times = []
+    # At least count calls, cycling through items, so short inputs still give a stable median
+    for i in range(max(count, len(items))):
+        item = items[i % len(items)]
+        start = time.perf_counter()
+        function(item)
+        times.append(time.perf_counter() - start)
+    return times
+
+def bench_img(args, content:str, directory:str, transport) -> tuple:
+    """
+    send_img.py: load, pad, encode and send one image per frame.
+    """
+    from PIL import Image, ImageOps
+    paths = write_images(synthetic_frames(content, (64, 64), min(args.frames, 16)), directory)
+    encoder = FrameEncoder(PanelLayout.single(mask=1), commit=True)
+
+    def load(path):
+        with Image.open(path) as im:
+            return np.asarray(ImageOps.pad(im, (64, 64), Image.Resampling.LANCZOS).convert("RGB"))
+
+    encode_times = time_calls(encoder.encode, [load(path) for path in paths], args.frames)
+    frames, elapsed = run_for(args, lambda i: transport.send(encoder.encode(load(paths[i % len(paths)]))))
+    return median_us(encode_times), frames, elapsed
+
+def bench_gif(args, content:str, directory:str, transport, layout:PanelLayout) -> tuple:
+    """
+    send_gif.py, send_gif_128.py: decode and pack once, then replay encode_words().
+    """
+    size = (layout.width, layout.height)
+    path = write_gif(synthetic_frames(content, size, min(args.frames, 32)), os.path.join(directory, "anim.gif"))
+    encoder = encoder_from_args(args, layout)
+    frames, durations = load_gif(path, size)
+    packed = encoder.pack_many(frames)
+    encode_times = time_calls(encoder.encode_words, packed, args.frames)
+    encoder = encoder_from_args(args, layout)
+    frames, elapsed = run_for(args, lambda i: transport.send(encoder.encode_words(packed[i % len(packed)])))
+    return median_us(encode_times), frames, elapsed
+
+def bench_vid(args, content:str, directory:str, transport, layout:PanelLayout, pipelined:bool) -> tuple:
+    """
+    send_vid_128.py (serial) and send_vid_vectorized.py (pipelined): decode,
+    scale, encode and send every frame of an MJPEG file, again until
+    args.min_time seconds have gone by.
+    """
+    size = (layout.width, layout.height)
+    path = write_video(synthetic_frames(content, size, args.frames), os.path.join(directory, "video.avi"))
+    encoder = encoder_from_args(args, layout, bgr=True)
+    encode_times = time_calls(encoder.encode, list(VideoSource(path, size)))
+    encoder = encoder_from_args(args, layout, bgr=True)
+    frames = 0
+    start = time.perf_counter()
+    while frames == 0 or time.perf_counter() - start < args.min_time:
+        source = VideoSource(path, size)
+        clock = FreeRunningClock()
+        if pipelined:
+            pipeline = FramePipeline(encoder, transport, depth=args.queue_depth, policy=args.drop)
+            pipeline.run(source, clock)
+            frames += pipeline.frames_sent
+        else:
+            for index, im in source.frames(skip=clock.is_past):
+                clock.wait(index)
+                transport.send(encoder.encode(im))
+                frames += 1
+    return median_us(encode_times), frames, time.perf_counter() - start
+
+def run_once(args, sender:str, content:str) -> dict:
+    sink = LoopbackSink()
+    args.ip, args.port = sink.address
+    transport = transport_from_args(args)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            if sender == "send_img":
+                encode_us, frames, elapsed = bench_img(args, content, directory, transport)
+            elif sender == "send_gif":
+                encode_us, frames, elapsed = bench_gif(args, content, directory, transport, PanelLayout.single(mask=1))
+            elif sender == "send_gif_128":
+                encode_us, frames, elapsed = bench_gif(args, content, directory, transport, PanelLayout.default())
+            else:
+                encode_us, frames, elapsed = bench_vid(args, content, directory, transport, PanelLayout.default(),
+                    pipelined=sender == "send_vid_vectorized")
+        sink.drain(transport.packets_sent)
+    finally:
+        transport.close()
+        sink.close()
+    return {
+        "frames"            : frames,
+        "encode_us"         : round(encode_us, 2),
+        "fps"               : round(frames/elapsed, 2),
+        "packets_per_s"     : round(transport.packets_sent/elapsed, 1),
+        "mbytes_per_s"      : round(transport.bytes_sent/elapsed/1e6, 3),
+        "packets_per_frame" : round(transport.packets_sent/max(frames, 1), 2),
+        "received"          : round(sink.packets/max(transport.packets_sent, 1), 4),
+    }
+
+def summarize(runs:list) -> dict:
+    """
+    Best of the runs of a case for the compared metrics, since interference only
+    ever slows a run down, and the median for the others. The spread of the
+    compared metrics, (max - min)/median over the runs, goes under "spread".
+    """
+    result = {metric: round(float(np.median([run[metric] for run in runs])), 4) for metric in runs[0]}
+    result["runs"] = len(runs)
+    result["spread"] = {}
+    for metric, higher_is_better in METRICS.items():
+        values = [run[metric] for run in runs]
+        if result[metric]:
+            result["spread"][metric] = round((max(values) - min(values))/result[metric], 4)
+        result[metric] = max(values) if higher_is_better else min(values)
+    return result
+
+# Baselines ----------------------------------------------------------------------------------------
+
+def compare(results:dict, baseline:dict, threshold:float) -> list:
+    """
+    Lines describing every metric that got worse than the baseline by more than
+    threshold (relative), or by more than the spread between runs on either side
+    when that is larger: such changes are indistinguishable from noise.
+    """
+    regressions = []
+    for name, metrics in results.items():
+        if name not in baseline:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            old, new = baseline[name].get(metric), metrics.get(metric)
+            if not old or new is None:
+                continue
+            limit = max(threshold, baseline[name].get("spread", {}).get(metric, 0.0),
+                metrics.get("spread", {}).get(metric, 0.0))
+            change = (new - old)/old
+            if (-change if higher_is_better else change) > limit:
+                regressions.append(f"{name}: {metric} {old} -> {new} ({change:+.1%}, limit {limit:.1%})")
+    return regressions
+
+def environment() -> dict:
+    return {
+        "python"   : platform.python_version(),
+        "numpy"    : np.__version__,
+        "machine"  : platform.machine(),
+        "processor": platform.processor(),
+        "time"     : time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+# Command line -------------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the sender paths against a loopback UDP sink.",
+        epilog="--ip and --port are ignored, packets always go to a local sink.")
+    parser.add_argument("--senders",   default=",".join(SENDERS),  help="Comma separated sender paths to run.")
+    parser.add_argument("--content",   default=",".join(CONTENTS), help="Comma separated synthetic contents.")
+    parser.add_argument("--frames",    default=240, type=int,      help="Least frames per run.")
+    parser.add_argument("--min-time",  default=1.0, type=float,    help="Least seconds per run.")
+    parser.add_argument("--repeat",    default=5,   type=int,      help="Runs per case, the best is reported.")
+    parser.add_argument("--save",      default=None,               help="Write the results to this JSON baseline.")
+    parser.add_argument("--compare",   default=None,               help="Compare against this JSON baseline.")
+    parser.add_argument("--threshold", default=0.1, type=float,    help="Relative change counted as a regression.")
+    add_encoder_arguments(parser)
+    add_transport_arguments(parser)
+    add_pipeline_arguments(parser)
+    args = parser.parse_args()
+
+    if args.repeat < 1:
+        parser.error("--repeat needs at least one run")
+    senders = args.senders.split(",")
+    contents = args.content.split(",")
+    for sender in senders:
+        if sender not in SENDERS:
+            parser.error(f"unknown sender {sender!r}, expected some of {','.join(SENDERS)}")
+    for content in contents:
+        if content not in CONTENTS:
+            parser.error(f"unknown content {content!r}, expected some of {','.join(CONTENTS)}")
+
+    # Everything that changes what is measured, so baselines are only compared like for like
+    options = {key: getattr(args, key) for key in ("frames", "min_time", "delta", "keyframe_interval", "dedupe", "max_payload",
+        "commit", "packet_format", "brightness", "gamma", "pps", "bps", "batch", "queue_depth", "drop")}
+
+    cases = {f"{sender}/{content}": (sender, content) for sender in senders for content in contents}
+    runs = {name: [] for name in cases}
+    for _ in range(args.repeat):
+        for name, (sender, content) in cases.items():
+            runs[name].append(run_once(args, sender, content))
+
+    results = {}
+    print(f"{'case':34} {'encode us':>10} {'fps':>9} {'spread':>7} {'packets/s':>10} {'MB/s':>8} {'received':>9}")
+    for name in cases:
+        metrics = results[name] = summarize(runs[name])
+        print(f"{name:34} {metrics['encode_us']:10.1f} {metrics['fps']:9.1f} {metrics['spread'].get('fps', 0):7.1%} "
+            f"{metrics['packets_per_s']:10.0f} {metrics['mbytes_per_s']:8.2f} {metrics['received']:9.2%}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"environment": environment(), "options": options, "results": results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("options") != options:
+            print("warning: baseline was recorded with different options")
+        regressions = compare(results, baseline["results"], args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print(f"no regressions above {args.threshold:.0%}")
+
+if __name__ == "__main__":
+    main()
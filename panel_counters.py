@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+# Polls the board's receive counters (wyrm.py, add_rx_counters) through a
+# litex_server and prints rates, to tune the senders' --pps to what the board
+# really takes. For Etherbone next to the UDP firmware, build with
+# --with-ethernet --with-etherbone, then:
+#
+#   litex_server --udp --udp-ip 192.168.10.50 &
+#   ./panel_counters.py --csr-csv csr.csv
+#
+# "busy" is the share of CPU time spent in udp_cb, and the capacity estimate
+# the packet rate at which it would reach 100% with the current traffic.
+
+import argparse
+import time
+
+# Counter name: CSR, all 32 bits wide
+COUNTERS = {
+    "packets": "main_panel_rx_packets",
+    "pixels":  "main_panel_rx_pixels",
+    "cycles":  "main_panel_rx_cycles",
+    "drops":   "ethmac_sram_writer_errors",
+}
+COUNTER_WRAP = 1 << 32
+
+def read_counters(wb) -> dict:
+    """
+    Current value of every counter the SoC has.
+    """
+    return {name: getattr(wb.regs, csr).read() for name, csr in COUNTERS.items() if hasattr(wb.regs, csr)}
+
+def rates(before:dict, after:dict, elapsed:float, clk_freq:float) -> str:
+    """
+    Counter increments per second between two reads less than a counter wrap apart.
+    """
+    delta = {name: (after[name] - before[name]) % COUNTER_WRAP for name in after}
+    line = f"{delta['packets']/elapsed:8.0f} packets/s {delta['pixels']/elapsed:10.0f} pixels/s"
+    if "drops" in delta:
+        line += f" {delta['drops']/elapsed:6.0f} drops/s"
+    busy = delta["cycles"]/clk_freq/elapsed
+    line += f"   busy {100*busy:5.1f}%"
+    if delta["packets"]:
+        per_packet = delta["cycles"]/clk_freq/delta["packets"]
+        line += f", {per_packet*1e6:6.1f} us/packet, capacity ~{1/per_packet:.0f} packets/s"
+    return line
+
+def main():
+    from litex import RemoteClient
+
+    parser = argparse.ArgumentParser(description="Print the board's receive rates, read through litex_server.")
+    parser.add_argument("--host",     default="localhost", help="litex_server host.")
+    parser.add_argument("--port",     default=1234,        type=int,   help="litex_server port.")
+    parser.add_argument("--csr-csv",  default="csr.csv",   help="CSR map of the SoC (wyrm.py --csr-csv).")
+    parser.add_argument("--interval", default=1.0,         type=float, help="Seconds between reads.")
+    parser.add_argument("--count",    default=None,        type=int,   help="Stop after this many lines.")
+    args = parser.parse_args()
+
+    wb = RemoteClient(host=args.host, port=args.port, csr_csv=args.csr_csv)
+    wb.open()
+    try:
+        if not hasattr(wb.regs, COUNTERS["packets"]):
+            raise SystemExit("The SoC has no receive counters, rebuild it with this wyrm.py")
+        clk_freq = wb.constants.d["config_clock_frequency"]
+        then, before = time.monotonic(), read_counters(wb)
+        lines = 0
+        while args.count is None or lines < args.count:
+            time.sleep(args.interval)
+            now, after = time.monotonic(), read_counters(wb)
+            print(rates(before, after, now - then, clk_freq))
+            then, before = now, after
+            lines += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        wb.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+# Board emulator for testing the senders without hardware: listens on a UDP
+# port and decodes datagrams the way the firmware (software/main.c, udp_cb)
+# and gateware do, into one 64x64 framebuffer per panel select bit.
+#
+#   ./panel_emulator.py --snapshot wall.png &
+#   ./send_vid_vectorized.py video.mp4 --ip 127.0.0.1
+
+import argparse
+import socket
+import time
+
+import numpy as np
+
+from panel_encoder import (ADDR_SHIFT, COLOR_MASK, HEADER_SIZE, PACKET_COMMIT, PACKET_PIXELS,
+    PACKET_RUNS, PANEL_PIXELS, RUN_HEADER_SIZE, unpack_run)
+from panel_layout import MAX_PANELS, PANEL_SIZE, PanelLayout, add_layout_arguments, layout_from_args
+from panel_transport import UDP_PORT
+
+# Enough for any UDP datagram
+RECV_SIZE = 65536
+
+# Statistics ---------------------------------------------------------------------------------------
+
+class EmulatorStats:
+    """
+    Receive counters. Gaps are the times between consecutive datagrams, the
+    largest one since the last report shows how bursty the sender is.
+    """
+    def __init__(self) -> None:
+        self.packets = 0
+        self.bytes = 0
+        self.pixels = 0
+        self.commits = 0
+        self.ignored = 0
+        self.gap_max = 0.0
+        self.first = None
+        self.last = None
+        self._mark = None
+
+    def received(self, now:float, nbytes:int) -> None:
+        if self.last is not None:
+            self.gap_max = max(self.gap_max, now - self.last)
+        else:
+            self.first = now
+        self.last = now
+        self.packets += 1
+        self.bytes += nbytes
+
+    @property
+    def idle(self) -> bool:
+        """
+        Nothing received since the previous report.
+        """
+        return self._mark is not None and self._mark[1] == self.packets
+
+    def report(self) -> str:
+        """
+        Rates and mean gap since the previous report (or the first datagram).
+        """
+        now = time.monotonic()
+        if self._mark is None:
+            self._mark = (self.first or now, 0, 0, 0, 0, self.first)
+        then, packets, nbytes, pixels, commits, last = self._mark
+        elapsed = max(now - then, 1e-9)
+        gaps = self.packets - packets - (last == self.first)
+        gap_mean = (self.last - last)/gaps if gaps > 0 else 0.0
+        line = (f"{(self.packets - packets)/elapsed:.0f} packets/s, {(self.bytes - nbytes)/elapsed/1e6:.2f} MB/s, "
+            f"{(self.pixels - pixels)/elapsed/PANEL_PIXELS:.1f} panel fills/s, {(self.commits - commits)/elapsed:.1f} commits/s, "
+            f"gap {gap_mean*1e3:.3f} ms mean {self.gap_max*1e3:.3f} ms max ({self.packets} packets, {self.commits} commits")
+        line += f", {self.ignored} ignored)" if self.ignored else ")"
+        self._mark = (now, self.packets, self.bytes, self.pixels, self.commits, self.last)
+        self.gap_max = 0.0
+        return line
+
+# Emulator -----------------------------------------------------------------------------------------
+
+class PanelEmulator:
+    """
+    Panel memories as the gateware holds them: one 18-bit B|R|G wire color per
+    pixel, indexed by the panel-local address, for every bit of the enable mask.
+
+    Without double_buffer every write shows up immediately and commits are only
+    counted. With double_buffer writes land in the back bank and a commit swaps
+    the front and back banks of the panels in its mask, like write_bank and
+    front_bank in ledpanel.v: afterwards writes go to the bank that holds the
+    frame before the one just shown.
+
+    Without pixel_csrs the firmware is built for gateware without the
+    panel_pixel CSRs, and PACKET_RUNS datagrams are dropped as it drops them.
+    """
+    def __init__(self, double_buffer:bool = False, pixel_csrs:bool = True) -> None:
+        self.double_buffer = double_buffer
+        self.pixel_csrs = pixel_csrs
+        self.back = np.zeros((MAX_PANELS, PANEL_PIXELS), dtype=np.uint32)
+        self.front = np.zeros_like(self.back) if double_buffer else self.back
+        self.stats = EmulatorStats()
+
+    def receive(self, payload, now:float = None) -> None:
+        """
+        Decode one datagram payload.
+        """
+        self.stats.received(time.monotonic() if now is None else now, len(payload))
+        if len(payload) < HEADER_SIZE:
+            return
+        mask, kind = payload[0], payload[1]
+        if kind == PACKET_PIXELS:
+            words = np.frombuffer(payload, dtype=">u4", count=(len(payload) - HEADER_SIZE)//4, offset=HEADER_SIZE)
+            self.write(mask, words >> ADDR_SHIFT, words & COLOR_MASK)
+        elif kind == PACKET_RUNS and self.pixel_csrs:
+            self._receive_runs(payload)
+        elif kind == PACKET_COMMIT:
+            self.stats.commits += 1
+            if self.double_buffer:
+                for select in self._selects(mask):
+                    front = self.front[select].copy()
+                    self.front[select] = self.back[select]
+                    self.back[select] = front
+        else:
+            self.stats.ignored += 1
+
+    def _receive_runs(self, payload) -> None:
+        mask = payload[0]
+        i = HEADER_SIZE
+        while i + RUN_HEADER_SIZE <= len(payload):
+            addr = payload[i] << 8 | payload[i + 1]
+            count = payload[i + 2] << 8 | payload[i + 3]
+            i += RUN_HEADER_SIZE
+            groups = -(-count // 4)
+            # The firmware gives up on the rest of a malformed datagram
+            if count == 0 or i + 9*groups > len(payload):
+                return
+            self.write(mask, np.arange(addr, addr + count), unpack_run(payload[i:i + 9*groups], count))
+            i += 9*groups
+
+    def write(self, mask:int, addrs:np.ndarray, colors:np.ndarray) -> None:
+        # The panel memory only decodes the low address bits
+        addrs = addrs & (PANEL_PIXELS - 1)
+        for select in self._selects(mask):
+            self.back[select, addrs] = colors
+        self.stats.pixels += len(colors)*bin(mask).count("1")
+
+    @staticmethod
+    def _selects(mask:int) -> list:
+        return [select for select in range(MAX_PANELS) if mask >> select & 1]
+
+    def panel_image(self, select:int) -> np.ndarray:
+        """
+        What panel select shows, as a 64x64x3 RGB uint8 image in the senders' channel order.
+        """
+        colors = self.front[select].reshape(PANEL_SIZE, PANEL_SIZE)
+        image = np.empty((PANEL_SIZE, PANEL_SIZE, 3), dtype=np.uint8)
+        image[..., 0] = (colors >> 6 & 0x3F) << 2
+        image[..., 1] = (colors & 0x3F) << 2
+        image[..., 2] = (colors >> 12 & 0x3F) << 2
+        return image
+
+    def canvas(self, layout:PanelLayout) -> np.ndarray:
+        """
+        The whole wall as the layout's HxWx3 RGB frame, undoing panel rotation and flips.
+        """
+        canvas = np.zeros(layout.shape, dtype=np.uint8)
+        y, x = np.mgrid[0:PANEL_SIZE, 0:PANEL_SIZE]
+        for panel in layout.panels:
+            tx, ty = panel.to_canvas(x, y)
+            select = panel.mask.bit_length() - 1
+            canvas[panel.y + ty, panel.x + tx] = self.panel_image(select)
+        return canvas
+
+    def save(self, path:str, layout:PanelLayout) -> None:
+        from PIL import Image
+        Image.fromarray(self.canvas(layout)).save(path)
+
+# Server -------------------------------------------------------------------------------------------
+
+def serve(emulator:PanelEmulator, host:str = "127.0.0.1", port:int = UDP_PORT, duration:float = None,
+        report_every:float = 1.0, report=print, snapshot=None, snapshot_every:float = None) -> None:
+    """
+    Receive and decode datagrams until duration seconds have passed (forever by
+    default). Every report_every seconds the rates go to report, and every
+    snapshot_every seconds snapshot() is called.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+    sock.bind((host, port))
+    sock.settimeout(0.1)
+    buf = bytearray(RECV_SIZE)
+    view = memoryview(buf)
+    start = time.monotonic()
+    next_report = start + report_every if report_every else None
+    next_snapshot = start + snapshot_every if snapshot and snapshot_every else None
+    try:
+        while duration is None or time.monotonic() - start < duration:
+            try:
+                nbytes = sock.recv_into(buf)
+                emulator.receive(view[:nbytes])
+            except socket.timeout:
+                pass
+            now = time.monotonic()
+            if next_report is not None and now >= next_report:
+                if emulator.stats.packets and not emulator.stats.idle:
+                    report(emulator.stats.report())
+                next_report = now + report_every
+            if next_snapshot is not None and now >= next_snapshot:
+                snapshot()
+                next_snapshot = now + snapshot_every
+    finally:
+        sock.close()
+        if snapshot:
+            snapshot()
+
+# Command line -------------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulate the board's UDP panel interface on this host.")
+    parser.add_argument("--host",           default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("--port",           default=UDP_PORT,    type=int,   help="UDP port to listen on.")
+    parser.add_argument("--double-buffer",  action="store_true", help="Emulate gateware built with --double-buffer.")
+    parser.add_argument("--no-pixel-csrs",  action="store_true", help="Emulate gateware without the panel_pixel CSRs, dropping run packets.")
+    parser.add_argument("--duration",       default=None,        type=float, help="Stop after this many seconds.")
+    parser.add_argument("--report-every",   default=1.0,         type=float, help="Seconds between rate reports.")
+    parser.add_argument("--snapshot",       default=None,        help="Save the wall to this PNG on exit.")
+    parser.add_argument("--snapshot-every", default=None,        type=float, help="Also save it every this many seconds.")
+    add_layout_arguments(parser)
+    args = parser.parse_args()
+
+    layout = layout_from_args(args)
+    emulator = PanelEmulator(double_buffer=args.double_buffer, pixel_csrs=not args.no_pixel_csrs)
+    snapshot = (lambda: emulator.save(args.snapshot, layout)) if args.snapshot else None
+    try:
+        serve(emulator, args.host, args.port, duration=args.duration, report_every=args.report_every,
+            snapshot=snapshot, snapshot_every=args.snapshot_every)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
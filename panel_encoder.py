@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+
+# Frame to UDP packet encoder shared by the sender scripts.
+#
+# The firmware (software/main.c, udp_cb) expects datagrams of the form:
+#   byte 0     .. panel enable mask, written straight into main_panel_en
+#   byte 1     .. packet type
+#   bytes 2..  .. type dependent
+# PACKET_PIXELS carries big-endian 32-bit words: addr[31:18] | B[17:12] | R[11:6] | G[5:0]
+# Every word carries its own pixel address, local to a 64x64 panel.
+# PACKET_COMMIT has no body: on double-buffered gateware it shows everything written so
+# far on the panels in the mask. Older firmware sees a pixel packet without pixels.
+# PACKET_RUNS carries one or more runs of contiguous pixels, each a big-endian 16-bit
+# start address and 16-bit pixel count followed by the 18-bit B|R|G pixels packed
+# four to 9 bytes, big-endian, the last group zero padded.
+
+import numpy as np
+
+from panel_layout import PANEL_SIZE, Panel, PanelLayout
+
+PANEL_PIXELS = PANEL_SIZE * PANEL_SIZE
+HEADER_SIZE = 2
+ADDR_SHIFT = 18
+PACKET_PIXELS = 0
+PACKET_COMMIT = 1
+PACKET_RUNS = 2
+PACKET_FORMATS = ("words", "runs")
+RUN_HEADER_SIZE = 4
+COLOR_MASK = (1 << ADDR_SHIFT) - 1
+# Largest UDP payload that fits a 1500 byte Ethernet MTU without fragmenting
+MAX_PAYLOAD = 1472
+# Levels per color channel on the wire
+COLOR_LEVELS = 64
+# Granularity at which --dedupe compares panels
+STRIP_ROWS = 4
+STRIP_WORDS = STRIP_ROWS * PANEL_SIZE
+
+# Color --------------------------------------------------------------------------------------------
+
+def read_mem(path:str) -> list:
+    """
+    Values of a $readmemh file such as 6bit_to_8bit_gamma.mem.
+    """
+    with open(path) as f:
+        return [int(value, 16) for line in f for value in line.split("//")[0].split()]
+
+def color_tables(brightness:float = 1.0, curve:list = None) -> tuple:
+    """
+    Three 256-entry uint32 tables turning an 8-bit channel into the B, R and G
+    fields of a pixel word. Channels are scaled by brightness, then cut to 6
+    bits; curve, when given, maps each 6-bit level on to the COLOR_LEVELS range
+    scaled to its own maximum (e.g. read_mem("6bit_to_8bit_gamma.mem")).
+    """
+    if not 0.0 <= brightness <= 1.0:
+        raise ValueError(f"brightness {brightness} out of range 0-1")
+    levels = (np.arange(256)*brightness).astype(np.uint32) >> 2
+    if curve is not None:
+        curve = np.asarray(curve, dtype=np.float64)
+        if len(curve) != COLOR_LEVELS or curve.max() <= 0:
+            raise ValueError(f"a color curve needs {COLOR_LEVELS} entries, not all zero")
+        levels = np.rint(curve[levels]*(COLOR_LEVELS - 1)/curve.max()).astype(np.uint32)
+    return levels << 12, levels << 6, levels
+
+# Encoder ------------------------------------------------------------------------------------------
+
+class FrameEncoder:
+    """
+    Packs HxWx3 uint8 frames into ready-to-send payloads.
+
+    Pixel words are packed into datagrams of up to max_payload bytes, one panel
+    mask per datagram; the firmware does not care how words are grouped since
+    each one carries its own address.
+
+    With commit, every frame ends with a PACKET_COMMIT for all panels of the
+    layout, for gateware built with --double-buffer.
+
+    packet_format "runs" sends full frames and deduplicated strips as address-free
+    PACKET_RUNS (2.25 bytes per pixel instead of 4); sparse delta updates stay words.
+
+    brightness and curve adjust colors on the host through color_tables(). Plain
+    quantization uses masks and shifts instead, which numpy does faster than the
+    table lookups.
+
+    Gather indices and address words are computed once per layout, and every
+    call to encode() reuses the same output buffer: the returned payloads are
+    only valid until the next call.
+    """
+    def __init__(self, layout:PanelLayout, bgr:bool = False, dedupe:bool = False,
+            max_payload:int = MAX_PAYLOAD, commit:bool = False, packet_format:str = "words",
+            brightness:float = 1.0, curve:list = None) -> None:
+        if packet_format not in PACKET_FORMATS:
+            raise ValueError(f"unknown packet format {packet_format!r}, expected one of {PACKET_FORMATS}")
+        self.layout = layout
+        self.bgr = bgr
+        self.dedupe = dedupe
+        self.commit = commit
+        self.packet_format = packet_format
+        self.max_payload = max_payload
+        self.words_per_packet = (max_payload - HEADER_SIZE) // 4
+        if self.words_per_packet < 1:
+            raise ValueError(f"max payload of {max_payload} bytes cannot hold a single pixel")
+        if packet_format == "runs" and max_payload < HEADER_SIZE + RUN_HEADER_SIZE + 9:
+            raise ValueError(f"max payload of {max_payload} bytes cannot hold a run, the runs format needs "
+                f"at least {HEADER_SIZE + RUN_HEADER_SIZE + 9}")
+
+        n_panels = len(layout.panels)
+        n_pixels = n_panels * PANEL_PIXELS
+        packets_per_panel = -(-PANEL_PIXELS // self.words_per_packet)
+
+        # Pixel i of panel p lives at local address i = (y << 6) | x
+        local_y, local_x = np.divmod(np.arange(PANEL_PIXELS), PANEL_SIZE)
+        index = np.empty(n_pixels, dtype=np.intp)
+        for p, panel in enumerate(layout.panels):
+            tile_x, tile_y = panel.to_canvas(local_x, local_y)
+            index[p*PANEL_PIXELS:(p+1)*PANEL_PIXELS] = \
+                (panel.y + tile_y) * layout.width + (panel.x + tile_x)
+        # Byte offsets of each channel in the flattened frame
+        r, g, b = (2, 1, 0) if bgr else (0, 1, 2)
+        self._index_r = index*3 + r
+        self._index_g = index*3 + g
+        self._index_b = index*3 + b
+        self._tables = None
+        if brightness != 1.0 or curve is not None:
+            self._tables = color_tables(brightness, curve)
+
+        self._addr = np.tile(np.arange(PANEL_PIXELS, dtype=np.uint32) << ADDR_SHIFT, n_panels)
+        self._words = np.empty(n_pixels, dtype=np.uint32)
+        self._chan = np.empty(n_pixels, dtype=np.uint8)
+        self._tmp = np.empty(n_pixels, dtype=np.uint32)
+        self._sparse = np.empty(n_pixels, dtype=">u4")
+
+        # Full frames: each panel's words, padded to a whole number of packets, in
+        # network order. One copy moves them into the payload rows.
+        self._staged = np.zeros((n_panels, packets_per_panel*self.words_per_packet), dtype=">u4")
+        self._wire = self._staged[:, :PANEL_PIXELS]
+        tail = PANEL_PIXELS - (packets_per_panel - 1)*self.words_per_packet
+        self._full_lengths = ([HEADER_SIZE + 4*self.words_per_packet]*(packets_per_panel - 1) + [HEADER_SIZE + 4*tail]) * n_panels
+        self._row_masks = np.repeat([panel.mask for panel in layout.panels], packets_per_panel)
+        n_full_rows = len(self._row_masks)
+
+        # Sparse output (delta, dedupe) needs at most one partial packet per distinct mask on top
+        n_rows = n_full_rows + min(2**n_panels - 1, n_panels * (PANEL_PIXELS // STRIP_WORDS))
+        self.buffer = np.zeros((n_rows, max_payload), dtype=np.uint8)
+        self._payload_bytes = self.buffer[:, HEADER_SIZE:HEADER_SIZE + 4*self.words_per_packet]
+        self.payloads = [memoryview(row) for row in self.buffer]
+
+        # Strips with the same index in different panels carry the same addresses,
+        # so identical strips can go out once with the panel masks OR-ed together
+        self._masks = [panel.mask for panel in layout.panels]
+        all_panels = 0
+        for mask in self._masks:
+            all_panels |= mask
+        self.commit_payload = bytes([all_panels, PACKET_COMMIT])
+        self._hash_weights = np.random.default_rng(0x5779726d).integers(
+            1, 2**63, STRIP_WORDS, dtype=np.uint64) | 1
+
+    def pack(self, frame:np.ndarray) -> np.ndarray:
+        """
+        Return the packed words for every panel in native byte order, panel by panel.
+        """
+        if frame.shape != self.layout.shape:
+            raise ValueError(f"expected a frame of shape {self.layout.shape}, got {frame.shape}")
+        flat = np.ascontiguousarray(frame, dtype=np.uint8).reshape(-1)
+        words, chan, tmp = self._words, self._chan, self._tmp
+
+        # The gather indices are always in range: "wrap" skips the bounds check and the buffered out
+        if self._tables is not None:
+            lut_b, lut_r, lut_g = self._tables
+            np.take(flat, self._index_b, out=chan, mode="wrap")
+            np.take(lut_b, chan, out=words, mode="wrap")
+            np.bitwise_or(words, self._addr, out=words)
+            for index, table in ((self._index_r, lut_r), (self._index_g, lut_g)):
+                np.take(flat, index, out=chan, mode="wrap")
+                np.take(table, chan, out=tmp, mode="wrap")
+                np.bitwise_or(words, tmp, out=words)
+            return words
+
+        np.copyto(words, self._addr)
+        for index, shift in ((self._index_b, 10), (self._index_r, 4)):
+            np.take(flat, index, out=chan, mode="wrap")
+            np.bitwise_and(chan, 0xFC, out=chan)
+            np.left_shift(chan, shift, out=tmp, dtype=np.uint32)
+            np.bitwise_or(words, tmp, out=words)
+        np.take(flat, self._index_g, out=chan, mode="wrap")
+        np.right_shift(chan, 2, out=chan)
+        np.bitwise_or(words, chan, out=words, dtype=np.uint32)
+        return words
+
+    def pack_many(self, frames:np.ndarray) -> np.ndarray:
+        """
+        Pack a whole NxHxWx3 stack of frames in one pass, returning an N x pixels array
+        of words that can be replayed later with encode_words().
+        """
+        frames = np.ascontiguousarray(frames, dtype=np.uint8)
+        if frames.shape[1:] != self.layout.shape:
+            raise ValueError(f"expected frames of shape {self.layout.shape}, got {frames.shape[1:]}")
+        flat = frames.reshape(len(frames), -1)
+        words = np.empty((len(frames), len(self._words)), dtype=np.uint32)
+        words[:] = self._addr
+        if self._tables is not None:
+            for index, table in zip((self._index_b, self._index_r, self._index_g), self._tables):
+                words |= table[np.take(flat, index, axis=1)]
+            return words
+        words |= (np.take(flat, self._index_b, axis=1) & 0xFC).astype(np.uint32) << 10
+        words |= (np.take(flat, self._index_r, axis=1) & 0xFC).astype(np.uint32) << 4
+        words |= np.take(flat, self._index_g, axis=1) >> 2
+        return words
+
+    def encode(self, frame:np.ndarray) -> list:
+        return self.encode_words(self.pack(frame))
+
+    def encode_words(self, words:np.ndarray) -> list:
+        payloads = self._frame_payloads(words)
+        if self.commit:
+            payloads.append(self.commit_payload)
+        return payloads
+
+    def _frame_payloads(self, words:np.ndarray) -> list:
+        return self._full_payloads(words)
+
+    def _full_payloads(self, words:np.ndarray) -> list:
+        if self.dedupe and len(self._masks) > 1:
+            return self._dedupe_payloads(words)
+        if self.packet_format == "runs":
+            colors = words.reshape(len(self._masks), PANEL_PIXELS)
+            return self._run_payloads([(mask, 0, colors[p]) for p, mask in enumerate(self._masks)])
+        np.copyto(self._wire, words.reshape(self._wire.shape))
+        n_rows = len(self._row_masks)
+        self.buffer[:n_rows, 0] = self._row_masks
+        self.buffer[:n_rows, 1] = PACKET_PIXELS
+        self._payload_bytes[:n_rows] = self._staged.view(np.uint8).reshape(n_rows, -1)
+        return [payload[:length] for payload, length in zip(self.payloads, self._full_lengths)]
+
+    def _dedupe_payloads(self, words:np.ndarray) -> list:
+        n_panels = len(self._masks)
+        strips = words.reshape(n_panels, -1, STRIP_WORDS)
+        n_strips = strips.shape[1]
+        hashes = (strips.astype(np.uint64) * self._hash_weights).sum(axis=2).tolist()
+        # Strip rows to send for each combined mask
+        groups = {}
+        for k in range(n_strips):
+            # [hash, panel, mask] of the first strip of each group of identical strips
+            leaders = []
+            for p in range(n_panels):
+                h = hashes[p][k]
+                for leader in leaders:
+                    if leader[0] == h and np.array_equal(strips[leader[1], k], strips[p, k]):
+                        leader[2] |= self._masks[p]
+                        break
+                else:
+                    leaders.append([h, p, self._masks[p]])
+            for h, p, mask in leaders:
+                groups.setdefault(mask, []).append(p*n_strips + k)
+
+        all_strips = strips.reshape(-1, STRIP_WORDS)
+        if self.packet_format == "runs":
+            return self._run_payloads(self._strip_runs(groups, all_strips, n_strips))
+
+        runs = []
+        start = 0
+        sparse = self._sparse.reshape(-1, STRIP_WORDS)
+        for mask, rows in groups.items():
+            end = start + len(rows)
+            sparse[start:end] = all_strips[rows]
+            runs.append((mask, start*STRIP_WORDS, end*STRIP_WORDS))
+            start = end
+        return self._packetize(runs)
+
+    def _strip_runs(self, groups:dict, all_strips:np.ndarray, n_strips:int) -> list:
+        """
+        Merge each mask's strips into runs of contiguous addresses.
+        """
+        runs = []
+        for mask, rows in groups.items():
+            rows = sorted(rows, key=lambda row: row % n_strips)
+            first = 0
+            for i in range(1, len(rows) + 1):
+                if i == len(rows) or rows[i] % n_strips != rows[i - 1] % n_strips + 1:
+                    addr = (rows[first] % n_strips) * STRIP_WORDS
+                    runs.append((mask, addr, all_strips[rows[first:i]].reshape(-1)))
+                    first = i
+        return runs
+
+    def _run_payloads(self, runs:list) -> list:
+        """
+        Turn (mask, start address, words) runs into PACKET_RUNS payloads, several
+        runs per datagram where they fit. Address bits in the words are ignored.
+        """
+        payloads = []
+        row = -1
+        used = self.max_payload
+        for mask, addr, colors in runs:
+            data = pack_run(colors)
+            pos = 0
+            while pos < len(colors):
+                groups = (self.max_payload - used - RUN_HEADER_SIZE) // 9
+                if row < 0 or self.buffer[row, 0] != mask or groups < 1:
+                    if row >= 0:
+                        payloads.append(self.payloads[row][:used])
+                    row += 1
+                    self.buffer[row, 0] = mask
+                    self.buffer[row, 1] = PACKET_RUNS
+                    used = HEADER_SIZE
+                    groups = (self.max_payload - used - RUN_HEADER_SIZE) // 9
+                count = min(len(colors) - pos, 4*groups)
+                size = 9*(-(-count // 4))
+                self.buffer[row, used:used + RUN_HEADER_SIZE] = \
+                    ((addr + pos) >> 8, (addr + pos) & 0xFF, count >> 8, count & 0xFF)
+                used += RUN_HEADER_SIZE
+                self.buffer[row, used:used + size] = data[9*(pos // 4):9*(pos // 4) + size]
+                used += size
+                pos += count
+        if row >= 0:
+            payloads.append(self.payloads[row][:used])
+        return payloads
+
+    def _packetize(self, runs:list) -> list:
+        """
+        Turn runs of (mask, start, end) slices of self._sparse into payloads.
+        """
+        payloads = []
+        row = 0
+        sparse_bytes = self._sparse.view(np.uint8)
+        step = 4*self.words_per_packet
+        for mask, start, end in runs:
+            for offset in range(4*start, 4*end, step):
+                chunk = sparse_bytes[offset:min(offset + step, 4*end)]
+                self.buffer[row, 0] = mask
+                self.buffer[row, 1] = PACKET_PIXELS
+                self._payload_bytes[row, :len(chunk)] = chunk
+                payloads.append(self.payloads[row][:HEADER_SIZE + len(chunk)])
+                row += 1
+        return payloads
+
+def pack_run(words:np.ndarray) -> np.ndarray:
+    """
+    Pack the 18-bit colors of words four to 9 bytes, as PACKET_RUNS expects.
+    """
+    colors = np.zeros(-(-len(words) // 4) * 4, dtype=np.uint32)
+    np.bitwise_and(words, COLOR_MASK, out=colors[:len(words)])
+    p0, p1, p2, p3 = colors.reshape(-1, 4).T
+    packed = np.empty((len(p0), 9), dtype=np.uint8)
+    packed[:, 0:4] = ((p0 << 14) | (p1 >> 4)).astype(">u4").view(np.uint8).reshape(-1, 4)
+    packed[:, 4:8] = ((p1 << 28) | (p2 << 10) | (p3 >> 8)).astype(">u4").view(np.uint8).reshape(-1, 4)
+    packed[:, 8] = p3 & 0xFF
+    return packed.reshape(-1)
+
+def unpack_run(data, count:int) -> np.ndarray:
+    """
+    Inverse of pack_run: count 18-bit colors from their 9-byte groups.
+    """
+    groups = np.frombuffer(data, dtype=np.uint8).reshape(-1, 9)
+    a = groups[:, 0:4].copy().view(">u4")[:, 0].astype(np.uint32)
+    c = groups[:, 4:8].copy().view(">u4")[:, 0].astype(np.uint32)
+    d = groups[:, 8].astype(np.uint32)
+    colors = np.empty((len(groups), 4), dtype=np.uint32)
+    colors[:, 0] = a >> 14
+    colors[:, 1] = ((a << 4) | (c >> 28)) & COLOR_MASK
+    colors[:, 2] = (c >> 10) & COLOR_MASK
+    colors[:, 3] = ((c << 8) | d) & COLOR_MASK
+    return colors.reshape(-1)[:count]
+
+class DeltaEncoder(FrameEncoder):
+    """
+    Only emits the pixels whose quantized value changed since the previous frame.
+
+    Changed words are packed densely into full-size packets, one panel mask per
+    packet. Every keyframe_interval frames (and on the first frame) the whole
+    frame is sent again, so pixels lost on the wire do not stay wrong forever.
+
+    With commit the panels are double buffered: a frame lands in the buffer that
+    held the frame before the previous one, so that is what it is diffed against,
+    and keyframes go out twice to fill both buffers.
+    """
+    def __init__(self, layout:PanelLayout, bgr:bool = False, dedupe:bool = False,
+            max_payload:int = MAX_PAYLOAD, commit:bool = False, packet_format:str = "words",
+            brightness:float = 1.0, curve:list = None, keyframe_interval:int = 60) -> None:
+        FrameEncoder.__init__(self, layout, bgr=bgr, dedupe=dedupe, max_payload=max_payload, commit=commit,
+            packet_format=packet_format, brightness=brightness, curve=curve)
+        self.keyframe_interval = keyframe_interval
+        # Oldest first: the contents of the buffer the next frame is written to comes first
+        self._history = [np.empty_like(self._words) for _ in range(2 if commit else 1)]
+        self.force_keyframe()
+
+    def force_keyframe(self) -> None:
+        self._frames_to_keyframe = 0
+        self._full_frames = len(self._history)
+
+    def _frame_payloads(self, words:np.ndarray) -> list:
+        last = self._history.pop(0)
+        self._history.append(last)
+        if self._frames_to_keyframe <= 0:
+            self._frames_to_keyframe = self.keyframe_interval
+            self._full_frames = len(self._history)
+        self._frames_to_keyframe -= 1
+        if self._full_frames > 0:
+            self._full_frames -= 1
+            np.copyto(last, words)
+            return self._full_payloads(words)
+
+        changed = np.flatnonzero(words != last)
+        np.copyto(last, words)
+        counts = np.bincount(changed // PANEL_PIXELS, minlength=len(self._masks)).tolist()
+        np.take(words, changed, out=self._sparse[:len(changed)])
+
+        runs = []
+        start = 0
+        for mask, count in zip(self._masks, counts):
+            runs.append((mask, start, start + count))
+            start += count
+        return self._packetize(runs)
+
+# Command line -------------------------------------------------------------------------------------
+
+def add_encoder_arguments(parser) -> None:
+    parser.add_argument("--delta",             action="store_true",  help="Only send pixels that changed since the previous frame.")
+    parser.add_argument("--keyframe-interval", default=60, type=int, help="In delta mode, resend the whole frame every N frames.")
+    parser.add_argument("--dedupe",            action="store_true",  help="Send strips that are identical across panels once, to all of them.")
+    parser.add_argument("--max-payload",       default=MAX_PAYLOAD, type=int, help="Largest UDP payload to send, in bytes.")
+    parser.add_argument("--commit",            action="store_true",  help="End every frame with a commit packet (gateware built with --double-buffer).")
+    parser.add_argument("--packet-format",     default="words", choices=PACKET_FORMATS,
+        help="Full frames as self-addressed 32-bit words, or as address-free runs (needs the panel_pixel CSRs).")
+    parser.add_argument("--brightness",        default=1.0, type=float, help="Scale every color channel by this factor (0-1).")
+    parser.add_argument("--gamma",             default=None, help="Color curve to apply on the host, a 64-entry .mem file such as 6bit_to_8bit_gamma.mem.")
+
+def encoder_from_args(args, layout:PanelLayout, bgr:bool = False) -> FrameEncoder:
+    curve = read_mem(args.gamma) if args.gamma else None
+    if args.packet_format == "runs" and not getattr(args, "etherbone", None):
+        # The Etherbone transport unpacks runs on the host, the firmware only with the CSRs
+        print("warning: --packet-format runs needs firmware and gateware with the panel_pixel CSRs, "
+            "older boards drop run packets and the panels stay dark")
+    if args.delta:
+        return DeltaEncoder(layout, bgr=bgr, dedupe=args.dedupe, max_payload=args.max_payload,
+            commit=args.commit, packet_format=args.packet_format, brightness=args.brightness, curve=curve,
+            keyframe_interval=args.keyframe_interval)
+    return FrameEncoder(layout, bgr=bgr, dedupe=args.dedupe, max_payload=args.max_payload,
+        commit=args.commit, packet_format=args.packet_format, brightness=args.brightness, curve=curve)
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+
+# Frame ingest daemon: owns the encoder and the board connection(s), and takes
+# frames from any number of local producer processes through a ring of frame
+# slots in shared memory. Producers render straight into a slot and publish it,
+# the daemon packs the newest published frame right out of shared memory, so
+# producers never copy, encode or send anything themselves.
+#
+#   python3 panel_ingest.py --dedupe --pps 2000 &
+#
+#   from panel_ingest import IngestClient
+#   client = IngestClient.attach()
+#   frame = client.acquire()    # height x width x 3 RGB uint8 view into the ring
+#   frame[:] = render()
+#   client.publish()
+#
+# The newest published frame wins: frames published while the previous one is
+# still being sent are skipped, and with several producers the wall shows
+# whichever one published last. Every slot carries a sequence counter, odd
+# while a producer writes the slot, which lets the daemon notice a frame that
+# got overwritten while it was packing it (a producer lapping the ring) and
+# drop it instead of showing a torn frame.
+
+import argparse
+import fcntl
+import os
+import tempfile
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from panel_encoder import add_encoder_arguments
+from panel_layout import add_layout_arguments
+from panel_metrics import add_metrics_arguments, instrument, metrics_from_args
+from panel_transport import add_transport_arguments
+from panel_wall import add_wall_arguments, sender_from_args
+
+RING_NAME = "wyrm"
+RING_SLOTS = 4
+RING_MAGIC = 0x57594E31
+# Header and slot headers are one cache line each, frames start cache line aligned
+RING_ALIGN = 64
+# Header fields, as uint64
+MAGIC, HEIGHT, WIDTH, SLOTS, NEXT, LATEST = range(6)
+
+# Ring ---------------------------------------------------------------------------------------------
+
+def _attach(name:str) -> shared_memory.SharedMemory:
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 the resource tracker unlinks the segment when any attached process exits
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+class FrameRing:
+    """
+    Shared memory holding a header and slots frame slots of shape height x width x 3.
+
+    Frame numbers count up from 1. Acquiring frame n claims slot n % slots and
+    sets its sequence to 2n - 1, publishing sets it to 2n and makes n the
+    latest frame unless a newer one was published already. Claiming a number
+    and updating the latest one happen under a file lock shared by all processes.
+    """
+    def __init__(self, shm:shared_memory.SharedMemory, owner:bool = False) -> None:
+        self.shm = shm
+        self.owner = owner
+        self._header = np.ndarray(RING_ALIGN//8, dtype=np.uint64, buffer=shm.buf)
+        if self._header[MAGIC] != RING_MAGIC:
+            raise ValueError(f"shared memory {shm.name!r} is not a frame ring")
+        self.shape = (int(self._header[HEIGHT]), int(self._header[WIDTH]), 3)
+        self.slots = int(self._header[SLOTS])
+        stride = self.slot_size(self.shape)
+        self._sequences = np.ndarray(self.slots, dtype=np.uint64, buffer=shm.buf, offset=RING_ALIGN,
+            strides=(stride,))
+        self.frames = np.ndarray((self.slots,) + self.shape, dtype=np.uint8, buffer=shm.buf,
+            offset=2*RING_ALIGN, strides=(stride,) + (self.shape[1]*3, 3, 1))
+        self._lock = open(self.lock_path(shm.name), "a")
+
+    @staticmethod
+    def slot_size(shape:tuple) -> int:
+        return RING_ALIGN + -(-shape[0]*shape[1]*3 // RING_ALIGN)*RING_ALIGN
+
+    @staticmethod
+    def lock_path(name:str) -> str:
+        return os.path.join(tempfile.gettempdir(), name.lstrip("/") + ".lock")
+
+    @classmethod
+    def create(cls, name:str, shape:tuple, slots:int = RING_SLOTS) -> "FrameRing":
+        """
+        New ring, replacing one left behind by a daemon that did not exit cleanly.
+        """
+        size = RING_ALIGN + slots*cls.slot_size(shape)
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        header = np.ndarray(RING_ALIGN//8, dtype=np.uint64, buffer=shm.buf)
+        header[:] = 0
+        header[HEIGHT], header[WIDTH], header[SLOTS] = shape[0], shape[1], slots
+        header[MAGIC] = RING_MAGIC
+        del header
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name:str = RING_NAME) -> "FrameRing":
+        return cls(_attach(name))
+
+    @property
+    def latest(self) -> int:
+        """
+        Number of the newest published frame, 0 before the first one.
+        """
+        return int(self._header[LATEST])
+
+    def acquire(self) -> tuple:
+        """
+        Claim the next frame: (number, writable view of its slot).
+        """
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        try:
+            number = int(self._header[NEXT]) + 1
+            self._header[NEXT] = number
+            self._sequences[number % self.slots] = 2*number - 1
+        finally:
+            fcntl.flock(self._lock, fcntl.LOCK_UN)
+        return number, self.frames[number % self.slots]
+
+    def publish(self, number:int) -> None:
+        self._sequences[number % self.slots] = 2*number
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        try:
+            if number > self._header[LATEST]:
+                self._header[LATEST] = number
+        finally:
+            fcntl.flock(self._lock, fcntl.LOCK_UN)
+
+    def read(self, number:int, function):
+        """
+        function(frame) on published frame number, straight from its slot. None
+        when the slot was claimed again before or while function ran.
+        """
+        index = number % self.slots
+        if self._sequences[index] != 2*number:
+            return None
+        result = function(self.frames[index])
+        if self._sequences[index] != 2*number:
+            return None
+        return result
+
+    def close(self) -> None:
+        """
+        Detach, and remove the ring when this process created it. Views handed
+        out by acquire() must be gone by then.
+        """
+        self._header = self._sequences = self.frames = None
+        self._lock.close()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+            try:
+                os.unlink(self.lock_path(self.shm.name))
+            except OSError:
+                pass
+
+# Client -------------------------------------------------------------------------------------------
+
+class IngestClient:
+    """
+    Producer side of the ring: acquire() a frame, draw into it (RGB, the daemon's
+    wall size), publish() it. Frames not published are never shown.
+    """
+    def __init__(self, ring:FrameRing) -> None:
+        self.ring = ring
+        self.shape = ring.shape
+        self._pending = None
+
+    @classmethod
+    def attach(cls, name:str = RING_NAME) -> "IngestClient":
+        return cls(FrameRing.attach(name))
+
+    def acquire(self) -> np.ndarray:
+        self._pending, frame = self.ring.acquire()
+        return frame
+
+    def publish(self) -> int:
+        """
+        Publish the frame from the last acquire(), returns its number.
+        """
+        if self._pending is None:
+            raise RuntimeError("publish() without acquire()")
+        number, self._pending = self._pending, None
+        self.ring.publish(number)
+        return number
+
+    def send(self, frame:np.ndarray) -> int:
+        """
+        Copy a finished frame into the ring and publish it.
+        """
+        self.acquire()[:] = frame
+        return self.publish()
+
+    def close(self) -> None:
+        self.ring.close()
+
+# Daemon -------------------------------------------------------------------------------------------
+
+class IngestDaemon:
+    """
+    Sends the newest published frame whenever there is one it did not send yet,
+    at most max_fps times a second. The ring is polled every poll seconds while idle.
+    """
+    def __init__(self, ring:FrameRing, encoder, transport, max_fps:float = None, poll:float = 0.001) -> None:
+        self.ring = ring
+        self.encoder = encoder
+        self.transport = transport
+        self.frame_time = 1.0/max_fps if max_fps else 0.0
+        self.poll = poll
+        self.frames_sent = 0
+        # Published but never sent: superseded by a newer frame, or overwritten while packing
+        self.skipped = 0
+        self.torn = 0
+
+    def summary(self) -> str:
+        return (f"{self.frames_sent} frames sent, {self.skipped} skipped, {self.torn} overwritten while packing, "
+            f"{self.transport.packets_sent} packets")
+
+    def run(self, duration:float = None, report_every:float = None, report=print) -> None:
+        start = time.monotonic()
+        next_report = start + report_every if report_every else None
+        next_frame = start
+        last = self.ring.latest
+        while duration is None or time.monotonic() - start < duration:
+            now = time.monotonic()
+            if next_report is not None and now >= next_report:
+                report(self.summary())
+                next_report = now + report_every
+            latest = self.ring.latest
+            if latest == last:
+                time.sleep(self.poll)
+                continue
+            if now < next_frame:
+                time.sleep(next_frame - now)
+                continue
+            self.skipped += latest - last - 1
+            last = latest
+            words = self.ring.read(latest, self.encoder.pack)
+            if words is None:
+                self.torn += 1
+                continue
+            self.transport.send(self.encoder.encode_words(words))
+            self.frames_sent += 1
+            next_frame = max(next_frame + self.frame_time, now)
+
+# Command line -------------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Send frames published by other processes through shared memory.")
+    parser.add_argument("--name",         default=RING_NAME,  help="Shared memory name producers attach to.")
+    parser.add_argument("--slots",        default=RING_SLOTS, type=int,   help="Frame slots in the ring.")
+    parser.add_argument("--max-fps",      default=None,       type=float, help="Frame rate limit (default: as published).")
+    parser.add_argument("--duration",     default=None,       type=float, help="Stop after this many seconds.")
+    parser.add_argument("--report-every", default=None,       type=float, help="Print counters every this many seconds.")
+    add_layout_arguments(parser)
+    add_encoder_arguments(parser)
+    # The FPGA can't keep up with unpaced bursts
+    add_transport_arguments(parser, default_pps=2000)
+    add_wall_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics = metrics_from_args(args)
+
+    # Producers write RGB frames of the whole wall
+    layout, encoder, transport = sender_from_args(args)
+    encoder, transport = instrument(metrics, encoder, transport)
+    ring = FrameRing.create(args.name, layout.shape, args.slots)
+    print(f"Ring {args.name!r}: {args.slots} slots of {layout.width}x{layout.height}")
+    daemon = IngestDaemon(ring, encoder, transport, max_fps=args.max_fps)
+    try:
+        daemon.run(duration=args.duration, report_every=args.report_every)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ring.close()
+        transport.close()
+    print(daemon.summary())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+# Panel wall layout, shared by the gateware (wyrm.py) and the host senders.
+#
+# A layout is a canvas size plus one entry per 64x64 panel:
+#   jumper .. Colorlight connector (j1..j8) the panel's RGB lines are wired to
+#   select .. bit of the panel enable mask (first UDP payload byte) that addresses it
+#   x, y   .. origin of the panel's tile on the canvas
+#   rotate .. clockwise rotation of the mounted panel, in degrees (0, 90, 180, 270)
+#   flip   .. panel is mirrored left to right
+# The first panel also drives the shared row select/clock/latch lines.
+#
+# Layouts are stored as JSON, see the layouts/ directory.
+#
+# Walls bigger than one board are a WallLayout: a canvas size plus one entry per board
+# with its address and UDP port, the origin of its region on the canvas and its own
+# panel layout (a file name relative to the wall file, or inline), and optionally the
+# address of its Etherbone stack for senders run with --etherbone.
+
+import json
+import os
+from dataclasses import dataclass, asdict
+
+PANEL_SIZE = 64
+MAX_PANELS = 8
+# UDP port the firmware listens on
+BOARD_PORT = 1234
+ROTATIONS = (0, 90, 180, 270)
+
+# Panel --------------------------------------------------------------------------------------------
+
+@dataclass(frozen=True)
+class Panel:
+    x: int
+    y: int
+    select: int = 0
+    jumper: int = None
+    rotate: int = 0
+    flip: bool = False
+    # Enable mask sent with this panel's pixels, 1 << select unless given
+    mask: int = None
+
+    def __post_init__(self) -> None:
+        if self.mask is None:
+            object.__setattr__(self, "mask", 1 << self.select)
+        if not 0 <= self.select < MAX_PANELS:
+            raise ValueError(f"panel select bit {self.select} out of range 0-{MAX_PANELS - 1}")
+        if self.jumper is not None and not 1 <= self.jumper <= MAX_PANELS:
+            raise ValueError(f"panel jumper j{self.jumper} out of range j1-j{MAX_PANELS}")
+        if self.rotate not in ROTATIONS:
+            raise ValueError(f"panel rotation {self.rotate} not one of {ROTATIONS}")
+
+    def to_canvas(self, x, y) -> tuple:
+        """
+        Map panel-local pixel coordinates to coordinates within the panel's tile.
+        Plain arithmetic, so x and y can be ints or numpy arrays.
+        """
+        last = PANEL_SIZE - 1
+        if self.flip:
+            x = last - x
+        if self.rotate == 90:
+            return last - y, x
+        if self.rotate == 180:
+            return last - x, last - y
+        if self.rotate == 270:
+            return y, last - x
+        return x, y
+
+# Layout -------------------------------------------------------------------------------------------
+
+class PanelLayout:
+    def __init__(self, width:int, height:int, panels:list) -> None:
+        self.width = width
+        self.height = height
+        self.panels = list(panels)
+        if not 1 <= len(self.panels) <= MAX_PANELS:
+            raise ValueError(f"a layout needs 1 to {MAX_PANELS} panels, got {len(self.panels)}")
+        for panel in self.panels:
+            if panel.x < 0 or panel.y < 0 \
+                    or panel.x + PANEL_SIZE > width \
+                    or panel.y + PANEL_SIZE > height:
+                raise ValueError(f"panel at ({panel.x}, {panel.y}) does not fit a {width}x{height} canvas")
+        jumpers = [panel.jumper for panel in self.panels if panel.jumper is not None]
+        if len(set(jumpers)) != len(jumpers):
+            raise ValueError("several panels are wired to the same jumper")
+        selects = [panel.select for panel in self.panels if panel.mask == 1 << panel.select]
+        if len(set(selects)) != len(selects):
+            raise ValueError("several panels share the same select bit")
+
+    @classmethod
+    def single(cls, mask:int = 1) -> "PanelLayout":
+        return cls(PANEL_SIZE, PANEL_SIZE, [Panel(0, 0, mask=mask)])
+
+    @classmethod
+    def grid(cls, cols:int, rows:int) -> "PanelLayout":
+        """
+        Panels in row-major order, panel i selected by mask bit i.
+        """
+        panels = []
+        for row in range(rows):
+            for col in range(cols):
+                panels.append(Panel(col*PANEL_SIZE, row*PANEL_SIZE, select=len(panels)))
+        return cls(cols*PANEL_SIZE, rows*PANEL_SIZE, panels)
+
+    @classmethod
+    def default(cls) -> "PanelLayout":
+        """
+        The 128x128 wall of four panels on jumpers 4, 3, 2, 1 (layouts/wall_128x128.json).
+        """
+        panels = [Panel(panel.x, panel.y, select=panel.select, jumper=4 - panel.select)
+            for panel in cls.grid(2, 2).panels]
+        return cls(2*PANEL_SIZE, 2*PANEL_SIZE, panels)
+
+    @classmethod
+    def from_dict(cls, data:dict) -> "PanelLayout":
+        return cls(data["width"], data["height"], [Panel(**panel) for panel in data["panels"]])
+
+    @classmethod
+    def load(cls, path:str) -> "PanelLayout":
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+    def to_dict(self) -> dict:
+        return {
+            "width"  : self.width,
+            "height" : self.height,
+            "panels" : [asdict(panel) for panel in self.panels],
+        }
+
+    @property
+    def shape(self) -> tuple:
+        return (self.height, self.width, 3)
+
+# Wall ---------------------------------------------------------------------------------------------
+
+@dataclass(frozen=True)
+class Board:
+    ip: str
+    layout: PanelLayout
+    port: int = BOARD_PORT
+    x: int = 0
+    y: int = 0
+    # Etherbone address for --etherbone, when the board has one besides ip
+    etherbone_ip: str = None
+
+class WallLayout:
+    def __init__(self, width:int, height:int, boards:list) -> None:
+        self.width = width
+        self.height = height
+        self.boards = list(boards)
+        if not self.boards:
+            raise ValueError("a wall needs at least one board")
+        for board in self.boards:
+            if board.x < 0 or board.y < 0 \
+                    or board.x + board.layout.width > width \
+                    or board.y + board.layout.height > height:
+                raise ValueError(f"board {board.ip} at ({board.x}, {board.y}) does not fit a {width}x{height} canvas")
+        addresses = [(board.ip, board.port) for board in self.boards]
+        if len(set(addresses)) != len(addresses):
+            raise ValueError("several boards share the same address and port")
+
+    @classmethod
+    def from_dict(cls, data:dict, directory:str = ".") -> "WallLayout":
+        boards = []
+        for board in data["boards"]:
+            board = dict(board)
+            layout = board.get("layout")
+            if layout is None:
+                board["layout"] = PanelLayout.default()
+            elif isinstance(layout, str):
+                board["layout"] = PanelLayout.load(os.path.join(directory, layout))
+            else:
+                board["layout"] = PanelLayout.from_dict(layout)
+            boards.append(Board(**board))
+        return cls(data["width"], data["height"], boards)
+
+    @classmethod
+    def load(cls, path:str) -> "WallLayout":
+        with open(path) as f:
+            return cls.from_dict(json.load(f), os.path.dirname(path))
+
+    @property
+    def shape(self) -> tuple:
+        return (self.height, self.width, 3)
+
+# Command line -------------------------------------------------------------------------------------
+
+def add_layout_arguments(parser) -> None:
+    parser.add_argument("--layout", default=None, help="Panel wall layout JSON (default: 2x2 panels, 128x128).")
+
+def layout_from_args(args) -> PanelLayout:
+    if args.layout is None:
+        return PanelLayout.default()
+    return PanelLayout.load(args.layout)
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+# Sender instrumentation: per-stage timers, counters and a rolling p50/p99
+# summary, written periodically as JSON lines or as a Prometheus text file
+# (for node_exporter's textfile collector), and optional cProfile of a run.
+#
+# Stages, each timed once per frame:
+#   decode .. reading the next frame from the source (cv2 read, raw readinto)
+#   scale  .. resizing and letterboxing it to the wall size
+#   pack   .. quantizing and reordering the frame into panel words
+#   encode .. turning the words into datagram payloads
+#   send   .. handing the payloads to the socket(s), pacing included
+#   pace   .. the part of send spent waiting for the pacer
+#
+# Timing a stage costs two perf_counter() calls and a deque append, a few
+# microseconds per frame in all, against frame times in the milliseconds.
+
+import argparse
+import atexit
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+# Samples per stage the percentiles are computed over
+METRICS_WINDOW = 1024
+METRICS_FORMATS = ("jsonl", "prom")
+QUANTILES = (0.5, 0.99)
+
+# Metrics ------------------------------------------------------------------------------------------
+
+class Metrics:
+    """
+    Stage durations (a rolling window plus all-time totals) and counters.
+    add() and count() may be called from any thread; each stage and counter is
+    expected to be updated from a single one.
+    """
+    def __init__(self, window:int = METRICS_WINDOW) -> None:
+        self.window = window
+        self.start = time.monotonic()
+        self._samples = {}
+        self._totals = {}
+        self._counters = {}
+        self._watched = {}
+
+    def add(self, stage:str, seconds:float) -> None:
+        samples = self._samples.get(stage)
+        if samples is None:
+            samples = self._samples[stage] = deque(maxlen=self.window)
+            self._totals[stage] = [0, 0.0]
+        samples.append(seconds)
+        totals = self._totals[stage]
+        totals[0] += 1
+        totals[1] += seconds
+
+    def count(self, name:str, n:int = 1) -> None:
+        self._counters[name] = self._counters.get(name, 0) + n
+
+    def watch(self, name:str, function) -> None:
+        """
+        Counter kept elsewhere, read by calling function() when reporting.
+        """
+        self._watched[name] = function
+
+    def snapshot(self) -> dict:
+        """
+        Counters and, for every stage, count and sum since the start plus mean,
+        p50, p99 and max over the window, in seconds.
+        """
+        stages = {}
+        for stage, samples in list(self._samples.items()):
+            window = np.array(samples)
+            if not len(window):
+                continue
+            count, total = self._totals[stage]
+            p50, p99 = np.quantile(window, QUANTILES)
+            stages[stage] = {"count": count, "sum": total, "mean": float(window.mean()),
+                "p50": float(p50), "p99": float(p99), "max": float(window.max())}
+        counters = dict(self._counters)
+        for name, function in self._watched.items():
+            counters[name] = function()
+        return {"time": time.time(), "elapsed": time.monotonic() - self.start, "stages": stages, "counters": counters}
+
+def format_jsonl(snapshot:dict) -> str:
+    return json.dumps(snapshot, separators=(",", ":")) + "\n"
+
+def format_prometheus(snapshot:dict, prefix:str = "wyrm") -> str:
+    lines = [f"# HELP {prefix}_stage_seconds Sender stage duration per frame.",
+        f"# TYPE {prefix}_stage_seconds summary"]
+    for stage, stats in snapshot["stages"].items():
+        for quantile, key in zip(QUANTILES, ("p50", "p99")):
+            lines.append(f'{prefix}_stage_seconds{{stage="{stage}",quantile="{quantile}"}} {stats[key]:.9f}')
+        lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {stats["sum"]:.9f}')
+        lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+    for name, value in snapshot["counters"].items():
+        lines.append(f"# TYPE {prefix}_{name}_total counter")
+        lines.append(f"{prefix}_{name}_total {value}")
+    return "\n".join(lines) + "\n"
+
+# Instrumented stages ------------------------------------------------------------------------------
+
+class TimedEncoder:
+    """
+    Encoder wrapper timing pack() and encode_words(), everything else goes to the encoder.
+    """
+    def __init__(self, encoder, metrics:Metrics) -> None:
+        self.encoder = encoder
+        self.metrics = metrics
+
+    def __getattr__(self, name:str):
+        return getattr(self.encoder, name)
+
+    def pack(self, frame:np.ndarray) -> np.ndarray:
+        start = time.perf_counter()
+        words = self.encoder.pack(frame)
+        self.metrics.add("pack", time.perf_counter() - start)
+        return words
+
+    def encode_words(self, words:np.ndarray) -> list:
+        start = time.perf_counter()
+        payloads = self.encoder.encode_words(words)
+        self.metrics.add("encode", time.perf_counter() - start)
+        return payloads
+
+    def encode(self, frame:np.ndarray) -> list:
+        return self.encode_words(self.pack(frame))
+
+class TimedTransport:
+    """
+    Transport wrapper timing send() and the pacer waits within it, and counting frames.
+    """
+    def __init__(self, transport, metrics:Metrics) -> None:
+        self.transport = transport
+        self.metrics = metrics
+        metrics.watch("packets", lambda: transport.packets_sent)
+        metrics.watch("bytes", lambda: transport.bytes_sent)
+        metrics.watch("refused", lambda: transport.packets_refused)
+
+    def __getattr__(self, name:str):
+        return getattr(self.transport, name)
+
+    def send(self, payloads:list) -> None:
+        waited = self.transport.waited
+        start = time.perf_counter()
+        self.transport.send(payloads)
+        self.metrics.add("send", time.perf_counter() - start)
+        self.metrics.add("pace", self.transport.waited - waited)
+        self.metrics.count("frames")
+
+def instrument(metrics:Metrics, encoder, transport, source=None, clock=None) -> tuple:
+    """
+    (encoder, transport) reporting to metrics, unchanged without metrics. The
+    source's stages are timed as well, and the clock's late and dropped frames counted.
+    """
+    if metrics is None:
+        return encoder, transport
+    if source is not None:
+        source.metrics = metrics
+    if clock is not None:
+        metrics.watch("late", lambda: clock.late)
+        metrics.watch("dropped", lambda: clock.dropped + clock.skipped)
+    return TimedEncoder(encoder, metrics), TimedTransport(transport, metrics)
+
+# Output -------------------------------------------------------------------------------------------
+
+class MetricsReporter:
+    """
+    Writes a snapshot every interval seconds from a background thread, and a
+    last one on close(). JSON lines are appended; the Prometheus file is
+    replaced atomically, as the textfile collector expects.
+    """
+    def __init__(self, metrics:Metrics, path:str, interval:float = 5.0, format:str = "jsonl") -> None:
+        if format not in METRICS_FORMATS:
+            raise ValueError(f"unknown metrics format {format!r}, expected one of {METRICS_FORMATS}")
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.format = format
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics", daemon=True)
+        self._thread.start()
+
+    def write(self) -> None:
+        snapshot = self.metrics.snapshot()
+        if self.format == "jsonl":
+            with open(self.path, "a") as f:
+                f.write(format_jsonl(snapshot))
+        else:
+            with open(self.path + ".tmp", "w") as f:
+                f.write(format_prometheus(snapshot))
+            os.replace(self.path + ".tmp", self.path)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def close(self) -> None:
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join()
+        self.write()
+
+class ThreadProfiler:
+    """
+    cProfile for the thread calling start() and, before Python 3.12, every thread
+    started after it (decode workers, per-board senders), merged into one stats
+    file on stop(). From 3.12 on only one profiler may be active at a time, so
+    worker threads are not covered there.
+    """
+    # Python 3.12 turned cProfile into a sys.monitoring tool, one per interpreter
+    PER_THREAD = sys.version_info < (3, 12)
+
+    def __init__(self) -> None:
+        self._profiles = []
+
+    def _enable(self, *args) -> None:
+        profile = cProfile.Profile()
+        self._profiles.append(profile)
+        profile.enable()
+
+    def start(self) -> None:
+        if self.PER_THREAD:
+            # Called in every new thread before it runs, and replaced there by the thread's own profiler
+            threading.setprofile(self._enable)
+        self._enable()
+
+    def stop(self, path:str) -> None:
+        if self.PER_THREAD:
+            threading.setprofile(None)
+        profiles = []
+        for profile in self._profiles:
+            profile.disable()
+            profile.create_stats()
+            # Threads that ended before their first call have nothing to merge
+            if profile.stats:
+                profiles.append(profile)
+        if profiles:
+            pstats.Stats(*profiles).dump_stats(path)
+
+# Command line -------------------------------------------------------------------------------------
+
+def add_metrics_arguments(parser) -> None:
+    parser.add_argument("--metrics",        default=None,    help="Write per-stage timings and counters to this file.")
+    parser.add_argument("--metrics-every",  default=5.0,     type=float, help="Seconds between metrics writes.")
+    parser.add_argument("--metrics-format", default="jsonl", choices=METRICS_FORMATS,
+        help="Append JSON lines, or keep a Prometheus text file up to date.")
+    parser.add_argument("--profile",        default=None,    help="Run under cProfile and save the stats here.")
+
+def metrics_from_args(args) -> Metrics:
+    """
+    Metrics reported as --metrics asks for, None without --metrics. Starts
+    --profile as well. The last report and the profile are written at exit,
+    however the sender ends.
+    """
+    metrics = None
+    if args.metrics:
+        metrics = Metrics()
+        reporter = MetricsReporter(metrics, args.metrics, args.metrics_every, args.metrics_format)
+        atexit.register(reporter.close)
+    if args.profile:
+        profiler = ThreadProfiler()
+        profiler.start()
+        # Runs first at exit, before the last metrics write
+        atexit.register(profiler.stop, args.profile)
+    return metrics
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize a JSON lines metrics file.")
+    parser.add_argument("path", help="File written with --metrics.")
+    args = parser.parse_args()
+
+    with open(args.path) as f:
+        snapshot = json.loads(f.readlines()[-1])
+    print(f"after {snapshot['elapsed']:.1f} s: " + ", ".join(f"{value} {name}" for name, value in snapshot["counters"].items()))
+    for stage, stats in snapshot["stages"].items():
+        print(f"  {stage:<7} p50 {stats['p50']*1e3:8.3f} ms  p99 {stats['p99']*1e3:8.3f} ms  "
+            f"max {stats['max']*1e3:8.3f} ms  ({stats['count']} frames, {stats['sum']:.2f} s)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+# Staged sender: decoding, scaling and packing run on a worker thread and feed
+# a bounded queue of packed frames, while the calling thread only turns them
+# into payloads and paces them out. Decode then overlaps network time, and the
+# sustained frame rate is set by the slowest stage instead of their sum.
+
+import threading
+import time
+from collections import deque
+
+# Queue --------------------------------------------------------------------------------------------
+
+class FrameQueue:
+    """
+    Bounded frame queue with an explicit overflow policy:
+      "block"  .. the producer waits for room, playback slows down instead of losing frames
+      "oldest" .. the oldest queued frame is dropped, playback keeps up with a live source
+    With a file source the decoder is usually ahead of playback, so "block" is the one to use.
+    """
+    policies = ("block", "oldest")
+
+    def __init__(self, depth:int = 8, policy:str = "block") -> None:
+        if policy not in self.policies:
+            raise ValueError(f"unknown drop policy {policy!r}, expected one of {self.policies}")
+        self.depth = depth
+        self.policy = policy
+        self.dropped = 0
+        self._items = deque()
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def put(self, item) -> None:
+        with self._cond:
+            if self.policy == "block":
+                while len(self._items) >= self.depth and not self._closed:
+                    self._cond.wait()
+            elif len(self._items) >= self.depth:
+                self._items.popleft()
+                self.dropped += 1
+            if self._closed:
+                return
+            self._items.append(item)
+            self._cond.notify_all()
+
+    def get(self):
+        """
+        Next item, or None once the queue is closed and drained.
+        """
+        with self._cond:
+            while not self._items and not self._closed:
+                self._cond.wait()
+            if not self._items:
+                return None
+            item = self._items.popleft()
+            self._cond.notify_all()
+            return item
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+# Clock --------------------------------------------------------------------------------------------
+
+class PresentationClock:
+    """
+    Schedules frame n at start + n*frame_time on the monotonic clock, so a slow
+    frame never pushes back the ones after it and playback stays locked to the
+    source rate. The clock starts with the first frame waited for.
+
+    A frame is late when it goes out more than late_after seconds past its
+    deadline, and should be dropped once the next frame is already due.
+    """
+    def __init__(self, frame_time:float, late_after:float = None) -> None:
+        self.frame_time = frame_time
+        self.late_after = frame_time/4 if late_after is None else late_after
+        self.start = None
+        self.on_time = 0
+        self.late = 0
+        self.dropped = 0
+        # Dropped before decoding; counted apart as it is updated from the decode thread
+        self.skipped = 0
+
+    def deadline(self, index:int) -> float:
+        if self.start is None:
+            self.start = time.monotonic() - index*self.frame_time
+        return self.start + index*self.frame_time
+
+    def is_past(self, index:int) -> bool:
+        return self.start is not None and time.monotonic() > self.start + (index + 1)*self.frame_time
+
+    def wait(self, index:int) -> None:
+        delay = self.deadline(index) - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        if -delay > self.late_after:
+            self.late += 1
+        else:
+            self.on_time += 1
+
+    def summary(self) -> str:
+        return f"{self.on_time} frames on time, {self.late} late, {self.dropped + self.skipped} dropped"
+
+# Pipeline -----------------------------------------------------------------------------------------
+
+class FramePipeline:
+    """
+    The worker thread is the only caller of encoder.pack(); it hands over copies of
+    the packed words, so the encoder's payload buffers (and the delta state) are
+    only touched by the sending thread.
+    """
+    def __init__(self, encoder, transport, depth:int = 8, policy:str = "block") -> None:
+        self.encoder = encoder
+        self.transport = transport
+        self.queue = FrameQueue(depth, policy)
+        self.frames_sent = 0
+        self._error = None
+
+    def _produce(self, source, clock:PresentationClock) -> None:
+        try:
+            # Frames already past their slot are grabbed but never decoded
+            for index, frame in source.frames(skip=clock.is_past):
+                if frame is None:
+                    clock.skipped += 1
+                    continue
+                self.queue.put((index, self.encoder.pack(frame).copy()))
+        except BaseException as e:
+            self._error = e
+        finally:
+            self.queue.close()
+
+    def run(self, source, clock:PresentationClock) -> None:
+        """
+        Play every frame of source, which must provide frames(skip) like
+        panel_sources.VideoSource, on the schedule kept by clock.
+        """
+        worker = threading.Thread(target=self._produce, args=(source, clock), name="decode", daemon=True)
+        worker.start()
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                index, words = item
+                if clock.is_past(index):
+                    clock.dropped += 1
+                    continue
+                clock.wait(index)
+                self.transport.send(self.encoder.encode_words(words))
+                self.frames_sent += 1
+        finally:
+            self.queue.close()
+            clock.dropped += self.queue.dropped
+            self.queue.dropped = 0
+        worker.join()
+        if self._error is not None:
+            raise self._error
+
+# Command line -------------------------------------------------------------------------------------
+
+def add_pipeline_arguments(parser) -> None:
+    parser.add_argument("--queue-depth", default=8, type=int, help="Packed frames buffered between decoding and sending.")
+    parser.add_argument("--drop", default="block", choices=FrameQueue.policies,
+        help="When the queue is full: block the decoder, or drop the oldest queued frame (live sources).")
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+# Frame sources for the sender scripts. Every source yields HxWx3 uint8 frames
+# sized for the wall, ready for panel_encoder.FrameEncoder.
+
+import sys
+import time
+
+import numpy as np
+
+# Raw video pixel formats (as ffmpeg names them) and whether they are BGR
+RAW_FORMATS = {"rgb24": False, "bgr24": True}
+
+def load_gif(path:str, size:tuple, default_duration:float = 0.1) -> tuple:
+    """
+    Decode every frame of an animation once, padded to size = (width, height).
+
+    Returns (frames, durations): an N x height x width x 3 RGB array and the
+    per-frame display time in seconds, taken from the GIF itself when present.
+    """
+    from PIL import Image, ImageOps, ImageSequence
+
+    frames = []
+    durations = []
+    with Image.open(path) as im:
+        for frame in ImageSequence.Iterator(im):
+            thumb = ImageOps.pad(frame.convert("RGB"), size, Image.Resampling.LANCZOS)
+            frames.append(np.asarray(thumb))
+            duration = frame.info.get("duration", 0)
+            durations.append(duration/1000.0 if duration else default_duration)
+    return np.stack(frames), durations
+
+class VideoSource:
+    """
+    Frames from anything cv2.VideoCapture can open, scaled to fit size = (width, height)
+    while keeping the aspect ratio and letterboxed with black borders. Frames are BGR.
+    """
+    def __init__(self, path:str, size:tuple = (128, 128)) -> None:
+        import cv2
+        self.cv2 = cv2
+        self.size = size
+        self.bgr = True
+        self.capture = cv2.VideoCapture(path)
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS) or 30.0
+        # Times decode and scale when set, see panel_metrics.instrument()
+        self.metrics = None
+
+    def letterbox(self, shape:tuple) -> tuple:
+        # First we need to calculate how to resize while maintaining the original aspect ratio
+        o_shape = (shape[1], shape[0])
+        ratio = min(float(self.size[0])/float(o_shape[0]), float(self.size[1])/float(o_shape[1]))
+        n_size = tuple([int(x*ratio) for x in o_shape])
+
+        # Now we need to calculate the border we add after resizing to hit the requested size
+        delta_w = self.size[0] - n_size[0]
+        delta_h = self.size[1] - n_size[1]
+        top, bottom = delta_h//2, delta_h-(delta_h//2)
+        left, right = delta_w//2, delta_w-(delta_w//2)
+        return n_size, (top, bottom, left, right)
+
+    def scale(self, im:np.ndarray) -> np.ndarray:
+        cv2 = self.cv2
+        n_size, (top, bottom, left, right) = self.letterbox(im.shape)
+        im = cv2.resize(im, n_size)
+        return cv2.copyMakeBorder(im, top, bottom, left, right, cv2.BORDER_CONSTANT, value=((0, 0, 0)))
+
+    def frames(self, skip=None):
+        """
+        Yield (index, frame) pairs. Frames for which skip(index) is true are only
+        grabbed, never decoded or scaled, and come out as (index, None).
+        """
+        index = 0
+        while True:
+            if skip is not None and skip(index):
+                if not self.capture.grab():
+                    return
+                yield index, None
+            else:
+                start = time.perf_counter()
+                success, im = self.capture.read()
+                if not success:
+                    return
+                decoded = time.perf_counter()
+                im = self.scale(im)
+                if self.metrics is not None:
+                    self.metrics.add("decode", decoded - start)
+                    self.metrics.add("scale", time.perf_counter() - decoded)
+                yield index, im
+            index += 1
+
+    def __iter__(self):
+        for index, frame in self.frames():
+            yield frame
+
+class RawVideoSource:
+    """
+    Headerless rawvideo frames of exactly size = (width, height) from a file, a
+    FIFO or stdin ("-"), e.g. decoded, scaled and letterboxed by ffmpeg:
+
+      ffmpeg -i input.mp4 -vf "scale=128:128:force_original_aspect_ratio=decrease,pad=128:128:-1:-1" \\
+             -pix_fmt bgr24 -f rawvideo - | ./send_vid_vectorized.py - --raw bgr24 --fps 30
+
+    Frames are read with readinto() into one preallocated buffer, nothing is
+    decoded, scaled or allocated per frame. The frame yielded is overwritten by
+    the next one, so use it (or copy it) before asking for more.
+    """
+    def __init__(self, path:str, size:tuple = (128, 128), pixel_format:str = "bgr24", fps:float = 30.0) -> None:
+        if pixel_format not in RAW_FORMATS:
+            raise ValueError(f"unknown pixel format {pixel_format!r}, expected one of {tuple(RAW_FORMATS)}")
+        self.size = size
+        self.fps = fps
+        self.bgr = RAW_FORMATS[pixel_format]
+        self.frame = np.empty((size[1], size[0], 3), dtype=np.uint8)
+        self._view = memoryview(self.frame).cast("B")
+        self.metrics = None
+        # Unbuffered, readinto() then goes straight to the buffer
+        if path == "-":
+            self.stream = open(sys.stdin.fileno(), "rb", buffering=0, closefd=False)
+        else:
+            self.stream = open(path, "rb", buffering=0)
+
+    def read(self) -> bool:
+        """
+        Fill self.frame with the next frame, False at the end of the stream.
+        """
+        filled = 0
+        while filled < len(self._view):
+            # Pipes hand out at most their buffer size per read
+            n = self.stream.readinto(self._view[filled:])
+            if not n:
+                return False
+            filled += n
+        return True
+
+    def frames(self, skip=None):
+        """
+        Yield (index, frame) pairs like VideoSource.frames(), frames for which
+        skip(index) is true are read but come out as (index, None).
+        """
+        index = 0
+        while True:
+            start = time.perf_counter()
+            if not self.read():
+                return
+            if self.metrics is not None:
+                self.metrics.add("decode", time.perf_counter() - start)
+            yield index, None if skip is not None and skip(index) else self.frame
+            index += 1
+
+    def close(self) -> None:
+        self.stream.close()
+
+    def __iter__(self):
+        for index, frame in self.frames():
+            yield frame
+
+# Command line -------------------------------------------------------------------------------------
+
+def add_source_arguments(parser) -> None:
+    parser.add_argument("--raw", default=None, choices=tuple(RAW_FORMATS),
+        help="Read headerless raw video of exactly the wall size in this pixel format.")
+    parser.add_argument("--fps", default=None, type=float, help="Frame rate (default: the video's, 30 for --raw).")
+
+def source_from_args(args, path:str, size:tuple):
+    """
+    RawVideoSource with --raw, VideoSource otherwise. Either has .bgr and .fps,
+    with --fps overriding the rate the video reports.
+    """
+    if args.raw:
+        return RawVideoSource(path, size, args.raw, args.fps or 30.0)
+    source = VideoSource(path, size)
+    if args.fps:
+        source.fps = args.fps
+    return source
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+# Paced UDP output for the sender scripts.
+#
+# EtherboneTransport takes the same payloads but writes the pixels straight into
+# the panel memory window of gateware built with --with-etherbone, bypassing the
+# firmware and its CPU: Etherbone write bursts over UDP, paced the same way.
+
+import csv
+import errno
+import socket
+import struct
+import time
+
+import numpy as np
+
+from panel_encoder import (ADDR_SHIFT, HEADER_SIZE, PACKET_COMMIT, PACKET_PIXELS, PACKET_RUNS,
+    RUN_HEADER_SIZE, unpack_run)
+
+# Linux UDP generic segmentation offload: one sendmsg() carrying several
+# equally sized datagrams. Not exported by the socket module.
+SOL_UDP = getattr(socket, "SOL_UDP", 17)
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)
+UDP_MAX_SEGMENTS = 64
+UDP_MAX_GSO_BYTES = 65000
+# What sendmsg() fails with when the kernel, socket or route has no UDP GSO
+GSO_UNSUPPORTED = (errno.EINVAL, errno.ENOPROTOOPT, errno.EIO)
+
+# Address the board firmware listens on (software/main.c)
+UDP_IP = "192.168.10.30"
+UDP_PORT = 1234
+
+# Etherbone: address of the hardware stack next to the firmware (wyrm.py --etherbone-ip),
+# packet header (magic 4e6f, version 1, 32-bit addresses and data) and record limits
+ETHERBONE_IP = "192.168.10.50"
+ETHERBONE_PORT = 1234
+ETHERBONE_HEADER = bytes([0x4e, 0x6f, 0x10, 0x44, 0, 0, 0, 0])
+ETHERBONE_MAX_WRITES = 255
+# Panel memory window layout (wyrm.py add_ledpanel_csrs): word (mask << 12 | addr)
+PANEL_ADDR_BITS = 12
+
+# Pacer --------------------------------------------------------------------------------------------
+
+class Pacer:
+    """
+    Token bucket limiting packets and/or bytes per second.
+
+    The bucket is kept as a virtual send time: every send pushes it forward by
+    the time its packets and bytes cost at the configured rates, and at most
+    burst seconds of idle budget can be saved up. Waits shorter than spin are
+    busy-waited on perf_counter(); longer waits sleep for all but the last spin
+    seconds, which keeps sub-millisecond accuracy without spinning a core the
+    whole time.
+    """
+    def __init__(self, packets_per_second:float = None, bytes_per_second:float = None,
+            burst:float = 0.001, spin:float = 0.0002) -> None:
+        self.packets_per_second = packets_per_second
+        self.bytes_per_second = bytes_per_second
+        self.burst = burst
+        self.spin = spin
+        # Seconds spent waiting so far
+        self.waited = 0.0
+        self._next = time.perf_counter()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.packets_per_second or self.bytes_per_second)
+
+    def cost(self, packets:int, nbytes:int) -> float:
+        cost = 0.0
+        if self.packets_per_second:
+            cost = packets/self.packets_per_second
+        if self.bytes_per_second:
+            cost = max(cost, nbytes/self.bytes_per_second)
+        return cost
+
+    def wait(self, packets:int = 1, nbytes:int = 0) -> None:
+        """
+        Block until the budget allows sending packets datagrams totalling nbytes.
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        start = max(self._next, now - self.burst)
+        self._next = start + self.cost(packets, nbytes)
+        delay = start - now
+        if delay > 0:
+            self.waited += delay
+            if delay > self.spin:
+                time.sleep(delay - self.spin)
+            while time.perf_counter() < start:
+                # Lets other sender threads (one per board of a wall) run meanwhile
+                time.sleep(0)
+
+# Transport ----------------------------------------------------------------------------------------
+
+class UdpTransport:
+    """
+    Connected UDP socket sending payload lists through a Pacer.
+
+    With batch > 1, runs of equally sized payloads go out in a single
+    sendmsg() using UDP_SEGMENT where the kernel supports it. The pacer then
+    accounts for the whole batch at once, so batch bounds the burst size.
+
+    A connected socket reports ICMP port unreachable replies as
+    ConnectionRefusedError on a later send. Like sendto() on an unconnected
+    socket would, the datagrams are dropped then (and counted in
+    packets_refused), so a sender survives the board or emulator going away.
+    """
+    def __init__(self, ip:str, port:int, pacer:Pacer = None, batch:int = 1) -> None:
+        self.address = (ip, port)
+        self.pacer = pacer or Pacer()
+        self.batch = min(batch, UDP_MAX_SEGMENTS)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.connect(self.address)
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.packets_refused = 0
+
+    @property
+    def waited(self) -> float:
+        return self.pacer.waited
+
+    def close(self) -> None:
+        self.sock.close()
+
+    def send(self, payloads:list) -> None:
+        if self.batch <= 1:
+            for payload in payloads:
+                self._send_one(payload)
+            return
+        i = 0
+        while i < len(payloads):
+            size = len(payloads[i])
+            j = i + 1
+            limit = min(len(payloads), i + self.batch, i + UDP_MAX_GSO_BYTES//size)
+            # Every segment but the last must be exactly size bytes
+            while j < limit and len(payloads[j - 1]) == size and len(payloads[j]) <= size:
+                j += 1
+            if j - i == 1:
+                self._send_one(payloads[i])
+            else:
+                self._send_batch(payloads[i:j], size)
+            i = j
+
+    def _send_one(self, payload) -> None:
+        self.pacer.wait(1, len(payload))
+        self._send_raw(payload)
+
+    def _send_raw(self, payload) -> None:
+        try:
+            self.sock.send(payload)
+        except ConnectionRefusedError:
+            self.packets_refused += 1
+            return
+        self.packets_sent += 1
+        self.bytes_sent += len(payload)
+
+    def _send_batch(self, payloads:list, size:int) -> None:
+        nbytes = sum(len(payload) for payload in payloads)
+        self.pacer.wait(len(payloads), nbytes)
+        try:
+            self.sock.sendmsg(payloads, [(SOL_UDP, UDP_SEGMENT, struct.pack("=H", size))])
+        except ConnectionRefusedError:
+            self.packets_refused += len(payloads)
+            return
+        except OSError as e:
+            if e.errno not in GSO_UNSUPPORTED:
+                raise
+            # No UDP GSO on this platform or route: send them one by one from now on
+            self.batch = 1
+            for payload in payloads:
+                self._send_raw(payload)
+            return
+        self.packets_sent += len(payloads)
+        self.bytes_sent += nbytes
+
+class EtherboneTransport(UdpTransport):
+    """
+    Writes the pixels of encoder payloads into the gateware's panel memory window
+    with Etherbone bursts, one record of up to 255 contiguous words per datagram.
+    A commit becomes a write to the panel_swap CSR, after which panel_swap_busy
+    is read back until the swap happened (up to swap_timeout seconds), as the
+    firmware does.
+
+    window is the byte address of the "panel" memory region, csrs the CSR byte
+    addresses by name, both from the SoC's csr.csv (read_csr_csv()).
+    """
+    def __init__(self, ip:str, port:int, window:int, csrs:dict, pacer:Pacer = None, batch:int = 1,
+            swap_timeout:float = 0.1) -> None:
+        UdpTransport.__init__(self, ip, port, pacer=pacer, batch=batch)
+        self.window = window
+        self.swap = csrs.get("main_panel_swap")
+        self.swap_busy = csrs.get("main_panel_swap_busy")
+        self.swap_timeout = swap_timeout
+        self.swap_timeouts = 0
+
+    @staticmethod
+    def record(address:int, words:np.ndarray) -> bytes:
+        return (ETHERBONE_HEADER + bytes([0, 0x0f, len(words), 0]) + struct.pack(">I", address)
+            + words.astype(">u4", copy=False).tobytes())
+
+    @staticmethod
+    def runs(payloads:list) -> list:
+        """
+        (mask, address, words) runs of contiguous pixels in pixel payloads, merged
+        across payloads. Words keep their address bits, the window ignores them.
+        """
+        runs = []
+        for payload in payloads:
+            mask, kind = payload[0], payload[1]
+            if kind == PACKET_PIXELS:
+                words = np.frombuffer(payload, dtype=">u4", count=(len(payload) - HEADER_SIZE)//4, offset=HEADER_SIZE)
+                addrs = words >> ADDR_SHIFT
+                breaks = np.flatnonzero(np.diff(addrs) != 1) + 1
+                for start, end in zip(np.r_[0, breaks], np.r_[breaks, len(words)]):
+                    runs.append((mask, int(addrs[start]), words[start:end]))
+            elif kind == PACKET_RUNS:
+                i = HEADER_SIZE
+                while i + RUN_HEADER_SIZE <= len(payload):
+                    addr, count = struct.unpack_from(">HH", payload, i)
+                    i += RUN_HEADER_SIZE
+                    end = i + 9*(-(-count // 4))
+                    if count == 0 or end > len(payload):
+                        break
+                    runs.append((mask, addr, unpack_run(payload[i:end], count)))
+                    i = end
+        merged = []
+        for mask, addr, words in runs:
+            if merged and merged[-1][0] == mask and merged[-1][1] + len(merged[-1][2]) == addr:
+                merged[-1] = (mask, merged[-1][1], np.concatenate((merged[-1][2], words)))
+            else:
+                merged.append((mask, addr, words))
+        return merged
+
+    def send(self, payloads:list) -> None:
+        pixels = []
+        for payload in payloads:
+            if len(payload) == HEADER_SIZE and payload[1] == PACKET_COMMIT:
+                self._send_pixels(pixels)
+                pixels = []
+                self.commit(payload[0])
+            else:
+                pixels.append(payload)
+        self._send_pixels(pixels)
+
+    def _send_pixels(self, payloads:list) -> None:
+        packets = []
+        for mask, addr, words in self.runs(payloads):
+            base = self.window + 4*((mask << PANEL_ADDR_BITS) | addr)
+            for i in range(0, len(words), ETHERBONE_MAX_WRITES):
+                packets.append(self.record(base + 4*i, words[i:i + ETHERBONE_MAX_WRITES]))
+        UdpTransport.send(self, packets)
+
+    def commit(self, mask:int) -> None:
+        if self.swap is None:
+            # Gateware without double buffering shows pixels as they arrive
+            return
+        self._send_one(self.record(self.swap, np.array([mask])))
+        if self.swap_busy is None:
+            return
+        deadline = time.monotonic() + self.swap_timeout
+        while self.read(self.swap_busy) & mask:
+            if time.monotonic() > deadline:
+                self.swap_timeouts += 1
+                return
+
+    def read(self, address:int) -> int:
+        """
+        One Etherbone read, 0 when the board does not answer in time.
+        """
+        self.sock.settimeout(self.swap_timeout)
+        try:
+            self.sock.send(ETHERBONE_HEADER + bytes([0, 0x0f, 0, 1]) + struct.pack(">II", 0, address))
+            reply = self.sock.recv(64)
+        except (socket.timeout, ConnectionRefusedError):
+            return 0
+        finally:
+            self.sock.settimeout(None)
+        # Header, record header, base address, then the value read
+        return struct.unpack_from(">I", reply, 16)[0] if len(reply) >= 20 else 0
+
+def read_csr_csv(path:str) -> tuple:
+    """
+    (CSR register byte addresses, memory region (origin, size)) by name, from a LiteX csr.csv.
+    """
+    csrs = {}
+    regions = {}
+    with open(path) as f:
+        for row in csv.reader(f):
+            if len(row) >= 4 and row[0] == "csr_register":
+                csrs[row[1]] = int(row[2], 0)
+            elif len(row) >= 4 and row[0] == "memory_region":
+                regions[row[1]] = (int(row[2], 0), int(row[3], 0))
+    return csrs, regions
+
+# Command line -------------------------------------------------------------------------------------
+
+def add_transport_arguments(parser, default_pps:float = None) -> None:
+    parser.add_argument("--ip",    default=UDP_IP,      type=str,   help=f"Board address (default: {UDP_IP}).")
+    parser.add_argument("--port",  default=UDP_PORT,    type=int,   help=f"Board UDP port (default: {UDP_PORT}).")
+    parser.add_argument("--pps",   default=default_pps, type=float, help="Packets per second budget (default: unlimited).")
+    parser.add_argument("--bps",   default=None,        type=float, help="Bytes per second budget (default: unlimited).")
+    parser.add_argument("--batch", default=1,           type=int,   help="Datagrams per send syscall where UDP GSO is available.")
+    parser.add_argument("--etherbone",    default=None,         help="csr.csv of a --with-etherbone build: write pixels over Etherbone, bypassing the CPU.")
+    parser.add_argument("--etherbone-ip", default=None,
+        help=f"Etherbone address (default: {ETHERBONE_IP} when the build has the firmware's MAC next to Etherbone, else --ip).")
+
+def transport_from_args(args, ip:str = None, port:int = None, etherbone_ip:str = None) -> UdpTransport:
+    """
+    Transport for --ip/--port, or to ip and port when given (one board of a wall).
+    With --etherbone, pixels go to the Etherbone address instead, unless the SoC
+    has no panel memory window: then the UDP firmware path is used after all.
+
+    The Etherbone address is etherbone_ip or --etherbone-ip when given. Otherwise
+    a build where the firmware keeps its own MAC ("ethmac" region) answers on
+    ETHERBONE_IP, and an Etherbone-only build on the board address itself.
+    """
+    pacer = Pacer(packets_per_second=args.pps, bytes_per_second=args.bps)
+    if getattr(args, "etherbone", None):
+        csrs, regions = read_csr_csv(args.etherbone)
+        if "panel" in regions:
+            address = etherbone_ip or args.etherbone_ip or (ETHERBONE_IP if "ethmac" in regions else ip or args.ip)
+            return EtherboneTransport(address, ETHERBONE_PORT, regions["panel"][0], csrs, pacer=pacer, batch=args.batch)
+        print(f"{args.etherbone} has no panel memory window, sending over UDP")
+    return UdpTransport(ip or args.ip, port or args.port, pacer=pacer, batch=args.batch)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+# Walls driven by several boards: the frame is sliced into each board's region,
+# encoded by one encoder per board and sent to all boards in parallel, each from
+# its own socket, pacer and thread.
+#
+# With --commit (gateware built with --double-buffer) the boards present frames in
+# sync: every board's commit packet is held back until all boards have been sent
+# their pixels, then the commits go out together and each board swaps at the end
+# of its current refresh. The firmware's UDP stack only accepts datagrams for its
+# own address, so the commit is sent to every board rather than broadcast.
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from panel_encoder import HEADER_SIZE, PACKET_COMMIT, PANEL_PIXELS, encoder_from_args
+from panel_layout import WallLayout, layout_from_args
+from panel_transport import transport_from_args
+
+# Encoder ------------------------------------------------------------------------------------------
+
+class WallEncoder:
+    """
+    One encoder per board behind the FrameEncoder interface: packed words are
+    the boards' words back to back, and encode_words() returns one payload list
+    per board, in wall order, for WallTransport.
+    """
+    def __init__(self, wall:WallLayout, encoders:list) -> None:
+        self.wall = wall
+        self.encoders = encoders
+        self.commit = encoders[0].commit
+        self._slices = []
+        start = 0
+        for board in wall.boards:
+            end = start + len(board.layout.panels)*PANEL_PIXELS
+            self._slices.append(slice(start, end))
+            start = end
+        self._words = np.empty(start, dtype=np.uint32)
+
+    def _regions(self, frames:np.ndarray) -> list:
+        return [frames[..., board.y:board.y + board.layout.height, board.x:board.x + board.layout.width, :]
+            for board in self.wall.boards]
+
+    def pack(self, frame:np.ndarray) -> np.ndarray:
+        if frame.shape != self.wall.shape:
+            raise ValueError(f"expected a frame of shape {self.wall.shape}, got {frame.shape}")
+        for encoder, region, words in zip(self.encoders, self._regions(frame), self._slices):
+            self._words[words] = encoder.pack(region)
+        return self._words
+
+    def pack_many(self, frames:np.ndarray) -> np.ndarray:
+        return np.concatenate([encoder.pack_many(region)
+            for encoder, region in zip(self.encoders, self._regions(frames))], axis=1)
+
+    def encode(self, frame:np.ndarray) -> list:
+        return self.encode_words(self.pack(frame))
+
+    def encode_words(self, words:np.ndarray) -> list:
+        return [encoder.encode_words(words[board]) for encoder, board in zip(self.encoders, self._slices)]
+
+    def force_keyframe(self) -> None:
+        for encoder in self.encoders:
+            if hasattr(encoder, "force_keyframe"):
+                encoder.force_keyframe()
+
+# Transport ----------------------------------------------------------------------------------------
+
+class WallTransport:
+    """
+    One transport and thread per board. send() takes a payload list per board
+    and returns once every board's share is out. A commit packet ending a list
+    is only sent once all boards got their pixels.
+    """
+    def __init__(self, transports:list) -> None:
+        self.transports = transports
+        self._barrier = threading.Barrier(len(transports))
+        self._pool = ThreadPoolExecutor(max_workers=len(transports), thread_name_prefix="board")
+
+    @property
+    def packets_sent(self) -> int:
+        return sum(transport.packets_sent for transport in self.transports)
+
+    @property
+    def bytes_sent(self) -> int:
+        return sum(transport.bytes_sent for transport in self.transports)
+
+    @property
+    def packets_refused(self) -> int:
+        return sum(transport.packets_refused for transport in self.transports)
+
+    @property
+    def waited(self) -> float:
+        # Boards are paced in parallel, the one that waited longest held up the frames
+        return max(transport.waited for transport in self.transports)
+
+    def close(self) -> None:
+        self._pool.shutdown()
+        for transport in self.transports:
+            transport.close()
+
+    @staticmethod
+    def _is_commit(payload) -> bool:
+        return len(payload) == HEADER_SIZE and payload[1] == PACKET_COMMIT
+
+    def _send_board(self, transport, payloads:list, sync:bool) -> None:
+        try:
+            if not sync:
+                transport.send(payloads)
+                return
+            transport.send(payloads[:-1])
+            self._barrier.wait()
+            transport.send(payloads[-1:])
+        except BaseException:
+            # Don't leave the other boards waiting for this one
+            self._barrier.abort()
+            raise
+
+    def send(self, payloads:list) -> None:
+        # Every board ends its frame with a commit, or none does
+        sync = len(self.transports) > 1 and all(board and self._is_commit(board[-1]) for board in payloads)
+        futures = [self._pool.submit(self._send_board, transport, board, sync)
+            for transport, board in zip(self.transports, payloads)]
+        try:
+            for future in futures:
+                future.result()
+        finally:
+            if self._barrier.broken:
+                self._barrier.reset()
+
+# Command line -------------------------------------------------------------------------------------
+
+def add_wall_arguments(parser) -> None:
+    parser.add_argument("--wall", default=None, help="Multi-board wall JSON, replaces --layout, --ip and --port.")
+
+def sender_from_args(args, bgr:bool = False) -> tuple:
+    """
+    (layout, encoder, transport) for the options of a sender script, where layout
+    is a WallLayout with --wall and a PanelLayout otherwise. Both give the frame size.
+    """
+    if args.wall is None:
+        layout = layout_from_args(args)
+        return layout, encoder_from_args(args, layout, bgr=bgr), transport_from_args(args)
+    wall = WallLayout.load(args.wall)
+    encoder = WallEncoder(wall, [encoder_from_args(args, board.layout, bgr=bgr) for board in wall.boards])
+    transport = WallTransport([transport_from_args(args, board.ip, board.port, board.etherbone_ip)
+        for board in wall.boards])
+    return wall, encoder, transport
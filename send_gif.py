@@ -1,49 +1,44 @@
 #!/bin/python3
-import socket
-import sys
+import argparse
 import time
-import numpy as np
-import PIL
-from PIL import Image
-from PIL import ImageSequence
 
-UDP_IP = '192.168.10.30'
-UDP_PORT = 1234
+from panel_encoder import PanelLayout, add_encoder_arguments, encoder_from_args
+from panel_metrics import add_metrics_arguments, instrument, metrics_from_args
+from panel_transport import add_transport_arguments, transport_from_args
+from panel_sources import load_gif
 
-num_rows = 64
-num_cols = num_rows
-fbuf = np.zeros((num_rows*4), dtype='u4')
+parser = argparse.ArgumentParser(description="Play an animated GIF on a single 64x64 panel.")
+parser.add_argument("image",                             help="GIF to play.")
+parser.add_argument("mask",       type=int,              help="Panel enable mask.")
+parser.add_argument("frame_time", type=float, nargs="?", default=0.1, help="Seconds per frame for frames without a GIF duration.")
+add_encoder_arguments(parser)
+add_transport_arguments(parser)
+add_metrics_arguments(parser)
+args = parser.parse_args()
+metrics = metrics_from_args(args)
 
-s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+layout = PanelLayout.single(mask=args.mask)
+encoder = encoder_from_args(args, layout)
 
-im = Image.open(sys.argv[1])
-size = 64, 64
+transport = transport_from_args(args)
+encoder, transport = instrument(metrics, encoder, transport)
 
-frame_time = float(sys.argv[3])
+# Decode and pack the whole animation once, then play back from the cache
+frames, durations = load_gif(args.image, (layout.width, layout.height), default_duration=args.frame_time)
+packed = encoder.pack_many(frames)
+del frames
 
+next_time = time.monotonic()
 while(1):
-    for frame in ImageSequence.Iterator(im):
-        thumb = PIL.ImageOps.pad(frame, size, Image.Resampling.LANCZOS)
-        thumb = thumb.convert("RGB")
-        cast = np.array(thumb)
-        for y in range(num_rows):
-            for x in range(num_cols):
-                addr = ((y & 0x3F) << 6) | (x & 0x3F);
-        
-                r = cast[y][x][2].item()
-                g = cast[y][x][0].item()
-                b = cast[y][x][1].item()
-        
-                fbuf[x+(num_cols*(y%4))] = socket.htonl((addr << 18) | (((int(r))&0xFC) << 10)
-                                                                     | (((int(g))&0xFC) << 4)
-                                                                     | (((int(b))&0xFC) >> 2))
-        
-            if (y % 4) == 3:
-                tosend = bytearray()
-                tosend.append(int(sys.argv[2]))
-                tosend.append(0)
-                tosend.extend(fbuf.tobytes())
-                s.sendto(tosend, (UDP_IP, UDP_PORT))
-        time.sleep(frame_time)
+    for words, duration in zip(packed, durations):
+        transport.send(encoder.encode_words(words))
+        next_time += duration
+        delay = next_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_time -= delay
+            if metrics is not None:
+                metrics.count("late")
 
 exit()
@@ -1,59 +1,45 @@
 #!/bin/python3
-import socket
-import sys
+import argparse
 import time
-import numpy as np
-import PIL
-from PIL import Image
-from PIL import ImageSequence
 
-UDP_IP = '192.168.10.30'
-UDP_PORT = 1234
+from panel_encoder import add_encoder_arguments
+from panel_layout import add_layout_arguments
+from panel_metrics import add_metrics_arguments, instrument, metrics_from_args
+from panel_transport import add_transport_arguments
+from panel_sources import load_gif
+from panel_wall import add_wall_arguments, sender_from_args
 
-num_rows = 128
-num_cols = num_rows
-fbuf = np.zeros((64*4), dtype='u4')
+parser = argparse.ArgumentParser(description="Play an animated GIF on the panel wall (128x128, four panels, by default).")
+parser.add_argument("image",                             help="GIF to play.")
+parser.add_argument("frame_time", type=float, nargs="?", default=0.1, help="Seconds per frame for frames without a GIF duration.")
+add_layout_arguments(parser)
+add_encoder_arguments(parser)
+add_transport_arguments(parser)
+add_wall_arguments(parser)
+add_metrics_arguments(parser)
+args = parser.parse_args()
+metrics = metrics_from_args(args)
 
-s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+# With --wall the frame is sliced across several boards
+layout, encoder, transport = sender_from_args(args)
+encoder, transport = instrument(metrics, encoder, transport)
 
-im = Image.open(sys.argv[1])
-size = 128, 128
-
-frame_time = float(sys.argv[2])
+# Decode and pack the whole animation once, then play back from the cache
+frames, durations = load_gif(args.image, (layout.width, layout.height), default_duration=args.frame_time)
+packed = encoder.pack_many(frames)
+del frames
 
+next_time = time.monotonic()
 while(1):
-    for frame in ImageSequence.Iterator(im):
-        thumb = PIL.ImageOps.pad(frame, size, Image.Resampling.LANCZOS)
-        thumb = thumb.convert("RGB")
-        cast = np.array(thumb)
-        for i in range(4):
-            for y in range(64):
-                for x in range(64):
-                    addr = ((y & 0x3F) << 6) | (x & 0x3F);
-        
-                    adj_y = y
-                    adj_x = x
-                    if i == 1:
-                        adj_x = adj_x + 64
-                    if i == 2:
-                        adj_y = adj_y + 64
-                    if i == 3:
-                        adj_x = adj_x + 64
-                        adj_y = adj_y + 64
-                    r = cast[adj_y][adj_x][2].item()
-                    g = cast[adj_y][adj_x][0].item()
-                    b = cast[adj_y][adj_x][1].item()
-        
-                    fbuf[x+(64*(y%4))] = socket.htonl((addr << 18) | (((int(r))&0xFC) << 10)
-                                                                       | (((int(g))&0xFC) << 4)
-                                                                       | (((int(b))&0xFC) >> 2))
-                if (y % 4) == 3:
-                    tosend = bytearray()
-                    tosend.append(1 << i)
-                    tosend.append(0)
-                    tosend.extend(fbuf.tobytes())
-                    s.sendto(tosend, (UDP_IP, UDP_PORT))
- 
-        time.sleep(frame_time)
+    for words, duration in zip(packed, durations):
+        transport.send(encoder.encode_words(words))
+        next_time += duration
+        delay = next_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_time -= delay
+            if metrics is not None:
+                metrics.count("late")
 
 exit()
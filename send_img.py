@@ -1,42 +1,28 @@
 #!/bin/python3
-import socket
-import sys
+import argparse
 import numpy as np
 import PIL
-from PIL import Image
+from PIL import Image, ImageOps
 
-UDP_IP = '192.168.10.30'
-UDP_PORT = 1234
+from panel_encoder import FrameEncoder, PanelLayout
+from panel_transport import add_transport_arguments, transport_from_args
 
-num_rows = 64
-num_cols = num_rows
-fbuf = np.zeros((num_rows*4), dtype='u4')
+parser = argparse.ArgumentParser(description="Show an image on a single 64x64 panel.")
+parser.add_argument("image",           help="Image to show.")
+parser.add_argument("mask",  type=int, help="Panel enable mask.")
+add_transport_arguments(parser)
+args = parser.parse_args()
 
-s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+# The commit shows the image on double-buffered gateware and is ignored otherwise
+encoder = FrameEncoder(PanelLayout.single(mask=args.mask), commit=True)
 
-im = Image.open(sys.argv[1])
+transport = transport_from_args(args)
+
+im = Image.open(args.image)
 size = 64, 64
 im = PIL.ImageOps.pad(im, size, Image.Resampling.LANCZOS)
+im = im.convert("RGB")
 
-cast = np.array(im)
-
-for y in range(num_rows):
-    for x in range(num_cols):
-        addr = ((y & 0x3F) << 6) | (x & 0x3F);
-
-        r = cast[y][x][2].item()
-        g = cast[y][x][0].item()
-        b = cast[y][x][1].item()
-
-        fbuf[x+(num_cols*(y%4))] = socket.htonl((addr << 18) | (((int(r))&0xFC) << 10)
-                                                             | (((int(g))&0xFC) << 4)
-                                                             | (((int(b))&0xFC) >> 2))
-
-    if (y % 4) == 3:
-        tosend = bytearray()
-        tosend.append(int(sys.argv[2]))
-        tosend.append(0)
-        tosend.extend(fbuf.tobytes())
-        s.sendto(tosend, (UDP_IP, UDP_PORT))
+transport.send(encoder.encode(np.asarray(im)))
 
 exit()
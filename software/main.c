@@ -11,11 +11,39 @@
 #include <libliteeth/inet.h>
 #include <libliteeth/udp.h>
 #include <generated/csr.h>
+#ifdef CSR_SDRAM_BASE
+#include <liblitedram/sdram.h>
+#endif
 
-void udp_cb(unsigned int src_ip, unsigned short src_port, unsigned short dst_port, void *data, unsigned int length);
-void udp_cb(unsigned int src_ip, unsigned short src_port, unsigned short dst_port, void *data, unsigned int length)
+/* Board address, set at build time with ./wyrm.py --eth-ip and --eth-mac */
+#ifndef WYRM_IP1
+#define WYRM_IP1 192
+#define WYRM_IP2 168
+#define WYRM_IP3 10
+#define WYRM_IP4 30
+#endif
+#ifndef WYRM_MAC1
+#define WYRM_MAC1 0x72
+#define WYRM_MAC2 0x6b
+#define WYRM_MAC3 0x89
+#define WYRM_MAC4 0x5b
+#define WYRM_MAC5 0xc2
+#define WYRM_MAC6 0xe2
+#endif
+
+/* Second payload byte: packet type */
+#define PACKET_PIXELS 0 /* 32-bit self-addressed pixel words follow */
+#define PACKET_COMMIT 1 /* show the frame written so far on the panels in the mask */
+#define PACKET_RUNS   2 /* runs of contiguous pixels: address, count, 18-bit pixels four to 9 bytes */
+
+static void write_words(const uint8_t *buf, unsigned int length)
 {
-    uint8_t *buf = (uint8_t *)data;
+#ifdef CSR_MAIN_PANEL_PIXEL_ADDR
+    /* One CSR write per pixel, the gateware unpacks the wire word */
+    main_panel_select_write(buf[0]);
+    for (uint32_t i = 2; i + 4 <= length; i += 4)
+        main_panel_pixel_write(ntohl(*((uint32_t *)(&(buf[i])))));
+#else
     for (uint32_t i = 2; i < length; i += 4) {
         main_panel_en_write(0);
         const uint32_t stuff = ntohl(*((uint32_t *)(&(buf[i]))));
@@ -28,6 +56,157 @@ void udp_cb(unsigned int src_ip, unsigned short src_port, unsigned short dst_por
         main_panel_en_write(buf[0]);
     }
     main_panel_en_write(0);
+#endif
+}
+
+#ifdef CSR_MAIN_PANEL_PIXEL_ADDR
+static void write_runs(const uint8_t *buf, unsigned int length)
+{
+    main_panel_select_write(buf[0]);
+    uint32_t i = 2;
+    while (i + 4 <= length) {
+        const uint32_t addr = (buf[i] << 8) | buf[i + 1];
+        const uint32_t count = (buf[i + 2] << 8) | buf[i + 3];
+        i += 4;
+        if (count == 0 || i + 9*((count + 3)/4) > length)
+            return;
+        /* The first pixel sets the address, the rest auto-increment from there */
+        for (uint32_t n = 0; n < count; n += 4, i += 9) {
+            const uint32_t a = ((uint32_t)buf[i] << 24) | (buf[i + 1] << 16) | (buf[i + 2] << 8) | buf[i + 3];
+            const uint32_t c = ((uint32_t)buf[i + 4] << 24) | (buf[i + 5] << 16) | (buf[i + 6] << 8) | buf[i + 7];
+            const uint32_t px[4] = {
+                a >> 14,
+                ((a << 4) | (c >> 28)) & 0x3ffff,
+                (c >> 10) & 0x3ffff,
+                ((c << 8) | buf[i + 8]) & 0x3ffff,
+            };
+            const uint32_t k_end = count - n < 4 ? count - n : 4;
+            uint32_t k = 0;
+            if (n == 0)
+                main_panel_pixel_write((addr << 18) | px[k++]);
+            for (; k < k_end; k++)
+                main_panel_pixel_next_write(px[k]);
+        }
+    }
+}
+#endif
+
+#if defined(CSR_MAIN_PANEL_SWAP_ADDR) && defined(MAIN_RAM_BASE)
+/*
+ * A swap lands at the end of the refresh in progress, up to ~5 ms with chained
+ * panels. Nothing may be written to the panels in the mask until then, but
+ * waiting inside udp_cb leaves the MAC's receive slots full and the start of
+ * the next frame gets dropped. Instead, datagrams arriving in the meantime are
+ * copied to a queue in main RAM (otherwise unused by the firmware) and handled
+ * from the main loop once panel_swap_busy clears. The firmware replaces the
+ * BIOS, so main() has to initialize the SDRAM before the queue can be used.
+ */
+#define SWAP_QUEUE_SLOTS 256
+#define SWAP_QUEUE_SLOT_SIZE 1536
+
+struct queued_packet {
+    unsigned int length;
+    uint8_t data[SWAP_QUEUE_SLOT_SIZE - sizeof(unsigned int)];
+};
+
+static struct queued_packet *const swap_queue = (struct queued_packet *)MAIN_RAM_BASE;
+static unsigned int swap_queue_head;
+static unsigned int swap_queue_count;
+static unsigned int swap_pending;
+/* Cleared when the SDRAM failed to initialize: commits then wait for the swap in udp_cb */
+static int swap_queue_ready = 1;
+#define DEFER_SWAP
+#endif
+
+static void handle_packet(const uint8_t *buf, unsigned int length)
+{
+    if (length < 2)
+        return;
+    switch (buf[1]) {
+    case PACKET_PIXELS:
+        write_words(buf, length);
+        break;
+#ifdef CSR_MAIN_PANEL_PIXEL_ADDR
+    case PACKET_RUNS:
+        write_runs(buf, length);
+        break;
+#endif
+    case PACKET_COMMIT:
+#ifdef CSR_MAIN_PANEL_SWAP_ADDR
+        main_panel_swap_write(buf[0]);
+#ifdef DEFER_SWAP
+        swap_pending = buf[0];
+#else
+        /* The swap lands at the end of the current refresh, hold off writing until then */
+        while (main_panel_swap_busy_read() & buf[0]);
+#endif
+#endif
+        break;
+    default:
+        /* Unknown packet type from a newer sender */
+        break;
+    }
+}
+
+#ifdef DEFER_SWAP
+/* Handle queued datagrams in order until the queue is empty or one of them is a commit */
+static void swap_queue_drain(void)
+{
+    while (swap_queue_count && !swap_pending) {
+        const struct queued_packet *packet = &swap_queue[swap_queue_head];
+        swap_queue_head = (swap_queue_head + 1) % SWAP_QUEUE_SLOTS;
+        swap_queue_count--;
+        handle_packet(packet->data, packet->length);
+    }
+}
+
+static void swap_poll(void)
+{
+    if (swap_pending && !(main_panel_swap_busy_read() & swap_pending)) {
+        swap_pending = 0;
+        swap_queue_drain();
+    }
+}
+
+static int swap_queue_push(const uint8_t *buf, unsigned int length)
+{
+    if (!swap_queue_ready || swap_queue_count == SWAP_QUEUE_SLOTS || length > sizeof(swap_queue[0].data))
+        return 0;
+    struct queued_packet *packet = &swap_queue[(swap_queue_head + swap_queue_count) % SWAP_QUEUE_SLOTS];
+    packet->length = length;
+    memcpy(packet->data, buf, length);
+    swap_queue_count++;
+    return 1;
+}
+#endif
+
+static void receive_packet(const uint8_t *buf, unsigned int length)
+{
+#ifdef DEFER_SWAP
+    swap_poll();
+    while (swap_pending) {
+        if (swap_queue_push(buf, length))
+            return;
+        /* Queue full: wait for the swap after all */
+        while (main_panel_swap_busy_read() & swap_pending);
+        swap_pending = 0;
+        swap_queue_drain();
+    }
+#endif
+    handle_packet(buf, length);
+}
+
+void udp_cb(unsigned int src_ip, unsigned short src_port, unsigned short dst_port, void *data, unsigned int length);
+void udp_cb(unsigned int src_ip, unsigned short src_port, unsigned short dst_port, void *data, unsigned int length)
+{
+#ifdef CSR_MAIN_PANEL_RX_ADDR
+    /* Counts the packet and the cycles until it is handled, see wyrm.py add_rx_counters */
+    main_panel_rx_write(1);
+#endif
+    receive_packet((const uint8_t *)data, length);
+#ifdef CSR_MAIN_PANEL_RX_ADDR
+    main_panel_rx_write(0);
+#endif
 }
 
 __attribute__((__used__)) int main(int argc, char **argv)
@@ -64,12 +243,22 @@ __attribute__((__used__)) int main(int argc, char **argv)
     printf("\e[1mCSR\e[0m:\t\t%d-bit data\n",
         CONFIG_CSR_DATA_WIDTH);
 
+#ifdef CSR_SDRAM_BASE
+    /* Nothing else set up the SDRAM, the swap queue lives there */
+    if (!sdram_init()) {
+        printf("\e[1mSDRAM initialization failed\e[0m, not queueing packets during swaps\n");
+#ifdef DEFER_SWAP
+        swap_queue_ready = 0;
+#endif
+    }
+#endif
+
 #ifdef CSR_ETHMAC_BASE
     eth_init();
 #endif
 
-    unsigned char mac[] = {0x72, 0x6b, 0x89, 0x5b, 0xc2, 0xe2};
-    udp_start(mac, IPTOINT(192, 168, 10, 30));
+    unsigned char mac[] = {WYRM_MAC1, WYRM_MAC2, WYRM_MAC3, WYRM_MAC4, WYRM_MAC5, WYRM_MAC6};
+    udp_start(mac, IPTOINT(WYRM_IP1, WYRM_IP2, WYRM_IP3, WYRM_IP4));
 
     udp_set_callback(udp_cb);
 
@@ -78,6 +267,9 @@ __attribute__((__used__)) int main(int argc, char **argv)
 
     while(1) {
         udp_service();
+#ifdef DEFER_SWAP
+        swap_poll();
+#endif
     }
 
     return 0;
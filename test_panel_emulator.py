@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# Round trip of every encoder mode through the board emulator: whatever the
+# senders encode has to show up on the emulated wall exactly, quantized to 6 bits.
+#
+#   python -m pytest test_panel_emulator.py
+
+import itertools
+
+import numpy as np
+import pytest
+
+from panel_emulator import PanelEmulator
+from panel_encoder import MAX_PAYLOAD, PACKET_FORMATS, DeltaEncoder, FrameEncoder
+from panel_layout import PANEL_SIZE, PanelLayout
+
+LAYOUTS = {
+    "single":  PanelLayout.single(),
+    "default": PanelLayout.default(),
+    "grid":    PanelLayout.grid(2, 2),
+}
+
+def frames(layout:PanelLayout, count:int = 8) -> list:
+    """
+    Noise with some panels repeating each other (for dedupe) and only a few
+    pixels changing between frames (for delta), some of them blinking back to
+    what they were two frames before (for delta on double buffers).
+    """
+    rng = np.random.default_rng(1234)
+    frame = rng.integers(0, 256, layout.shape, dtype=np.uint8)
+    if layout.width > PANEL_SIZE:
+        frame[:PANEL_SIZE, PANEL_SIZE:2*PANEL_SIZE] = frame[:PANEL_SIZE, :PANEL_SIZE]
+    blink = rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)
+    result = []
+    for n in range(count):
+        frame = frame.copy()
+        frame[:8, :8] = blink if n % 2 else 0
+        y = rng.integers(0, layout.height, 50)
+        x = rng.integers(0, layout.width, 50)
+        frame[y, x] = rng.integers(0, 256, (50, 3), dtype=np.uint8)
+        result.append(frame)
+    return result
+
+@pytest.mark.parametrize("layout_name, packet_format, dedupe, delta, commit, max_payload",
+    list(itertools.product(LAYOUTS, PACKET_FORMATS, (False, True), (False, True), (False, True), (MAX_PAYLOAD, 200))))
+def test_round_trip(layout_name, packet_format, dedupe, delta, commit, max_payload):
+    layout = LAYOUTS[layout_name]
+    if delta:
+        encoder = DeltaEncoder(layout, dedupe=dedupe, max_payload=max_payload, commit=commit,
+            packet_format=packet_format, keyframe_interval=3)
+    else:
+        encoder = FrameEncoder(layout, dedupe=dedupe, max_payload=max_payload, commit=commit,
+            packet_format=packet_format)
+    emulator = PanelEmulator(double_buffer=commit)
+    for n, frame in enumerate(frames(layout)):
+        for payload in encoder.encode(frame):
+            emulator.receive(bytes(payload), now=float(n))
+        np.testing.assert_array_equal(emulator.canvas(layout), frame & 0xFC, err_msg=f"frame {n}")
+
+def test_commit_swaps_banks():
+    emulator = PanelEmulator(double_buffer=True)
+    emulator.write(1, np.array([0]), np.array([1]))
+    emulator.receive(bytes([1, 1]))
+    emulator.write(1, np.array([0]), np.array([2]))
+    emulator.receive(bytes([1, 1]))
+    # The back bank holds the frame before the one shown, not a copy of it
+    assert emulator.front[0, 0] == 2
+    assert emulator.back[0, 0] == 1
+
+def test_runs_need_room_for_one_group():
+    for max_payload in (6, 12, 14):
+        with pytest.raises(ValueError):
+            FrameEncoder(PanelLayout.single(), packet_format="runs", max_payload=max_payload)
+    encoder = FrameEncoder(PanelLayout.single(), packet_format="runs", max_payload=15)
+    emulator = PanelEmulator()
+    frame = frames(PanelLayout.single(), 1)[0]
+    for payload in encoder.encode(frame):
+        emulator.receive(bytes(payload))
+    np.testing.assert_array_equal(emulator.canvas(PanelLayout.single()), frame & 0xFC)
+
+def test_runs_dropped_without_pixel_csrs():
+    layout = PanelLayout.single()
+    emulator = PanelEmulator(pixel_csrs=False)
+    for payload in FrameEncoder(layout, packet_format="runs").encode(frames(layout, 1)[0]):
+        emulator.receive(bytes(payload))
+    # Like the firmware built without CSR_MAIN_PANEL_PIXEL_ADDR
+    assert not emulator.canvas(layout).any()
+    assert emulator.stats.ignored == emulator.stats.packets
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+
+# ThreadProfiler with worker threads, as --profile runs the pipelined senders.
+#
+#   python -m pytest test_panel_metrics.py
+
+import pstats
+import threading
+
+from panel_metrics import ThreadProfiler
+
+def busy(result:list) -> None:
+    result.append(sum(range(1000)))
+
+def test_profiler_runs_threads(tmp_path):
+    path = str(tmp_path / "profile.pstats")
+    result = []
+    profiler = ThreadProfiler()
+    profiler.start()
+    thread = threading.Thread(target=busy, args=(result,))
+    thread.start()
+    thread.join(timeout=5)
+    busy(result)
+    profiler.stop(path)
+    # The worker ran its target despite the profiler
+    assert result == [499500, 499500]
+    functions = {name for _, _, name in pstats.Stats(path).stats}
+    assert "busy" in functions
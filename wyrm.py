@@ -1,5 +1,14 @@
 #!/usr/bin/env python3
 
+import functools
+import glob
+import hashlib
+import inspect
+import os
+import random
+import re
+import shutil
+import subprocess
 from typing import Any, Generator
 from migen import *
 from migen.fhdl.structure import _Assign
@@ -14,6 +23,8 @@ from litex_boards.platforms import colorlight_5a_75b
 from litex.soc.cores.clock import *
 from litex.soc.integration.soc_core import *
 from litex.soc.integration.builder import *
+from litex.soc.integration.soc import SoCRegion
+from litex.soc.interconnect import wishbone
 from litex.soc.interconnect.csr import *
 from litex.soc.cores.gpio import GPIOOut
 
@@ -23,6 +34,17 @@ from litedram.phy import GENSDRPHY, HalfRateGENSDRPHY
 from liteeth.phy.ecp5rgmii import LiteEthPHYRGMII
 from litex.build.generic_platform import *
 
+from bit_to_flash import bit_to_svf, save_manifest
+from panel_layout import MAX_PANELS, PanelLayout
+
+ROM_SIZE = 12288
+# Panel memory window: one 32-bit word per pixel address and panel enable mask
+PANEL_ADDR_BITS = 12
+PANEL_WINDOW_SIZE = 4 << (PANEL_ADDR_BITS + MAX_PANELS)
+# Ethernet MAC receive slots (LiteEth defaults to 2): room for the datagrams arriving
+# while the firmware is busy, e.g. right after a frame commit
+ETH_RX_SLOTS = 8
+
 # CRG ----------------------------------------------------------------------------------------------
 
 class _CRG(LiteXModule):
@@ -118,12 +140,17 @@ class BaseSoC(SoCCore):
         with_ethernet    = False,
         with_etherbone   = False,
         eth_ip           = "192.168.10.30",
+        eth_mac          = "72:6b:89:5b:c2:e2",
+        etherbone_ip     = "192.168.10.50",
         eth_phy          = 0,
         with_led_chaser  = False,
         use_internal_osc = False,
         sdram_rate       = "1:1",
         with_spi_flash   = False,
         rom              = None,
+        rom_init         = None,
+        layout           = None,
+        double_buffer    = False,
         **kwargs):
         platform = colorlight_5a_75b.Platform(revision=revision, toolchain=toolchain)
 
@@ -164,9 +191,11 @@ class BaseSoC(SoCCore):
         )
 
         # ROM --------------------------------------------------------------------------------------
-        kwargs["integrated_rom_size"] = 12288
-        if rom is not None:
-            kwargs["integrated_rom_init"] = get_mem_data(rom, endianness="little")
+        kwargs["integrated_rom_size"] = ROM_SIZE
+        if rom_init is None and rom is not None:
+            rom_init = get_mem_data(rom, endianness="little")
+        if rom_init is not None:
+            kwargs["integrated_rom_init"] = rom_init
 
         kwargs["integrated_sram_size"] = 8192
 
@@ -179,10 +208,14 @@ class BaseSoC(SoCCore):
         )
 
         # LED Panel --------------------------------------------------------------------------------
-        self.add_ledpanel(jumper=4, select=0, main_panel=True)
-        self.add_ledpanel(jumper=3, select=1)
-        self.add_ledpanel(jumper=2, select=2)
-        self.add_ledpanel(jumper=1, select=3)
+        if layout is None:
+            layout = PanelLayout.default()
+        for n, panel in enumerate(layout.panels):
+            if panel.jumper is None:
+                raise ValueError(f"panel at ({panel.x}, {panel.y}) has no jumper assigned")
+            self.add_ledpanel(jumper=panel.jumper, select=panel.select, main_panel=(n == 0),
+                double_buffer=double_buffer, with_bus=with_etherbone)
+        self.add_rx_counters()
 
         # SDR SDRAM --------------------------------------------------------------------------------
         if not self.integrated_main_ram_size:
@@ -204,8 +237,33 @@ class BaseSoC(SoCCore):
                 pads       = self.platform.request("eth", eth_phy),
                 tx_delay   = 0e-9)
             if with_ethernet:
-                self.add_ethernet(phy=self.ethphy, data_width=32)
-            if with_etherbone:
+                # Address the firmware's UDP stack answers on (software/main.c)
+                for i, byte in enumerate(eth_ip.split(".")):
+                    self.add_constant(f"WYRM_IP{i + 1}", int(byte))
+                for i, byte in enumerate(eth_mac.split(":")):
+                    self.add_constant(f"WYRM_MAC{i + 1}", int(byte, 16))
+            if with_ethernet and with_etherbone:
+                # Both share the PHY: Etherbone gets its own address in hardware, everything
+                # else goes to the firmware. Its MAC is the firmware's with one more locally
+                # administered bit, so it stays unique across the boards of a wall.
+                mac = int(eth_mac.replace(":", ""), 16)
+                etherbone_args = dict(phy=self.ethphy, ip_address=etherbone_ip, mac_address=mac ^ (0x04 << 40),
+                    data_width=32, with_ethmac=True, ethmac_address=mac, ethmac_local_ip=eth_ip)
+                if "ethmac_nrxslots" in inspect.signature(self.add_etherbone).parameters:
+                    self.add_etherbone(ethmac_nrxslots=ETH_RX_SLOTS, **etherbone_args)
+                else:
+                    # LiteX up to 2024.12 builds this MAC inside LiteEthUDPIPCore with the default
+                    # 2 receive slots and no way to pass more: give it ETH_RX_SLOTS while it does
+                    import liteeth.core
+                    mac_cls = liteeth.core.LiteEthMAC
+                    liteeth.core.LiteEthMAC = functools.partial(mac_cls, nrxslots=ETH_RX_SLOTS)
+                    try:
+                        self.add_etherbone(**etherbone_args)
+                    finally:
+                        liteeth.core.LiteEthMAC = mac_cls
+            elif with_ethernet:
+                self.add_ethernet(phy=self.ethphy, data_width=32, nrxslots=ETH_RX_SLOTS)
+            elif with_etherbone:
                 self.add_etherbone(phy=self.ethphy, ip_address=eth_ip, data_width=32)
 
         # SPI Flash --------------------------------------------------------------------------------
@@ -216,22 +274,117 @@ class BaseSoC(SoCCore):
             self.mem_map["spiflash"] = 0x20000000
             self.add_spi_flash(mode="1x", module=SpiFlashModule(SpiNorFlashOpCodes.READ_1_1_1), with_master=False)
 
-    def add_ledpanel_csrs(self) -> None:
+    def add_ledpanel_csrs(self, with_bus:bool = False) -> None:
         if not getattr(self, "panel_en", False):
-            self.panel_en = CSRStorage(size=4)
+            # Legacy interface: the enable mask is level sensitive, so a pixel takes
+            # four writes (disable, data, address, enable).
+            self.panel_en = CSRStorage(size=MAX_PANELS)
             self.panel_addr = CSRStorage(size=16)
             self.panel_wdat = CSRStorage(size=24)
 
-    def add_ledpanel(self, jumper:int, select:int, main_panel:bool = False) -> None:
+            # Single write interface: every write to panel_pixel commits one pixel to
+            # the panels selected in panel_select. The register takes the UDP wire
+            # word as is: addr[31:18] | B[17:12] | R[11:6] | G[5:0]. Writes to
+            # panel_pixel_next carry only the color bits and go to the address
+            # following the previous pixel, for contiguous runs.
+            self.panel_select = CSRStorage(size=MAX_PANELS)
+            self.panel_pixel = CSRStorage(size=32)
+            self.panel_pixel_next = CSRStorage(size=18)
+
+            # Frame commit: writing a mask to panel_swap shows everything written so far
+            # on those panels once their current refresh ends. panel_swap_busy stays
+            # set until then, nothing should be written in the meantime.
+            self.panel_swap = CSRStorage(size=MAX_PANELS)
+            self.panel_swap_busy = CSRStatus(size=MAX_PANELS)
+
+            self.pixel_we = Signal()
+            self.pixel_mask = Signal(MAX_PANELS)
+            self.pixel_addr = Signal(16)
+            self.pixel_wdat = Signal(24)
+            next_addr = Signal(16)
+
+            def color(word):
+                return Cat(word[0:6], Constant(0, 2), word[6:12], Constant(0, 2), word[12:18], Constant(0, 2))
+
+            # Panel memory window, for Etherbone: a write to word (mask << 12 | addr) of the
+            # "panel" region writes the color in its low 18 bits (B|R|G, so a wire word as
+            # is) to pixel addr of the panels in mask, without going through the CPU. Bursts
+            # of contiguous pixels become bursts of contiguous words. Reads return 0.
+            if with_bus:
+                self.panel_bus = bus = wishbone.Interface(data_width=32, address_width=32, addressing="word")
+                self.bus.add_slave("panel", bus, SoCRegion(size=PANEL_WINDOW_SIZE, cached=False))
+                # CSR pixel writes go first, the bus access waits a cycle
+                bus_access = Signal()
+                bus_write = Signal()
+                self.comb += [
+                    bus_access.eq(bus.cyc & bus.stb & ~bus.ack & ~self.panel_pixel.re & ~self.panel_pixel_next.re),
+                    bus_write.eq(bus_access & bus.we),
+                    bus.dat_r.eq(0),
+                ]
+                self.sync += bus.ack.eq(bus_access)
+
+            self.sync += [
+                self.pixel_we.eq(0),
+                If(self.panel_pixel.re,
+                    self.pixel_we.eq(1),
+                    self.pixel_mask.eq(self.panel_select.storage),
+                    self.pixel_addr.eq(self.panel_pixel.storage[18:32]),
+                    self.pixel_wdat.eq(color(self.panel_pixel.storage)),
+                    next_addr.eq(self.panel_pixel.storage[18:32] + 1),
+                ).Elif(self.panel_pixel_next.re,
+                    self.pixel_we.eq(1),
+                    self.pixel_mask.eq(self.panel_select.storage),
+                    self.pixel_addr.eq(next_addr),
+                    self.pixel_wdat.eq(color(self.panel_pixel_next.storage)),
+                    next_addr.eq(next_addr + 1),
+                )
+            ]
+            if with_bus:
+                self.sync += If(bus_write,
+                    self.pixel_we.eq(1),
+                    self.pixel_mask.eq(bus.adr[PANEL_ADDR_BITS:PANEL_ADDR_BITS + MAX_PANELS]),
+                    self.pixel_addr.eq(bus.adr[0:PANEL_ADDR_BITS]),
+                    self.pixel_wdat.eq(color(bus.dat_w)),
+                )
+
+    def add_rx_counters(self) -> None:
+        # Receive counters, polled from the host with panel_counters.py. The firmware
+        # sets panel_rx while it handles a datagram: every write of a 1 counts a packet,
+        # and the cycles it stays set are the CPU time spent in udp_cb. Pixel writes are
+        # counted once whatever the panels selected. Datagrams dropped because the CPU
+        # had no free receive slot are counted by the MAC (ethmac_sram_writer_errors).
+        # All counters wrap at 32 bits.
+        self.panel_rx = CSRStorage(size=1)
+        self.panel_rx_packets = CSRStatus(size=32)
+        self.panel_rx_pixels = CSRStatus(size=32)
+        self.panel_rx_cycles = CSRStatus(size=32)
+
+        self.sync += [
+            If(self.panel_rx.re & self.panel_rx.storage[0],
+                self.panel_rx_packets.status.eq(self.panel_rx_packets.status + 1),
+            ),
+            If(self.panel_rx.storage[0],
+                self.panel_rx_cycles.status.eq(self.panel_rx_cycles.status + 1),
+            ),
+            If(self.pixel_we | (self.panel_en.re & (self.panel_en.storage != 0)),
+                self.panel_rx_pixels.status.eq(self.panel_rx_pixels.status + 1),
+            ),
+        ]
+
+    def add_ledpanel(self, jumper:int, select:int, main_panel:bool = False, double_buffer:bool = False,
+            with_bus:bool = False) -> None:
         platform = self.platform
 
-        self.add_ledpanel_csrs()
+        self.add_ledpanel_csrs(with_bus=with_bus)
 
         panel = Instance("ledpanel",
+            Instance.Parameter("DOUBLE_BUFFER", int(double_buffer)),
             Instance.Input("ctrl_clk", ClockSignal()),
             Instance.Input("ctrl_en"),
             Instance.Input("ctrl_addr", Signal(16)),
             Instance.Input("ctrl_wdat", Signal(24)),
+            Instance.Input("ctrl_swap"),
+            Instance.Output("ctrl_swap_busy"),
             Instance.Input("display_clock", ClockSignal("sys")),
             Instance.Output("panel_r0"),
             Instance.Output("panel_g0"),
@@ -287,12 +440,92 @@ class BaseSoC(SoCCore):
         s_ctrl_wdat = panel_parameters.ctrl_wdat
 
         self.comb += [
-            s_ctrl_en.eq(self.panel_en.storage[select]),
-            s_ctrl_addr.eq(self.panel_addr.storage),
-            s_ctrl_wdat.eq(self.panel_wdat.storage),
+            panel_parameters.ctrl_swap.eq(self.panel_swap.re & self.panel_swap.storage[select]),
+            self.panel_swap_busy.status[select].eq(panel_parameters.ctrl_swap_busy),
+            If(self.pixel_we,
+                s_ctrl_en.eq(self.pixel_mask[select]),
+                s_ctrl_addr.eq(self.pixel_addr),
+                s_ctrl_wdat.eq(self.pixel_wdat),
+            ).Else(
+                s_ctrl_en.eq(self.panel_en.storage[select]),
+                s_ctrl_addr.eq(self.panel_addr.storage),
+                s_ctrl_wdat.eq(self.panel_wdat.storage),
+            )
         ]
 
 
+# Build cache --------------------------------------------------------------------------------------
+
+# The gateware is placed and routed with a fixed pseudo-random ROM, so its result only
+# depends on the gateware itself. It is cached by a hash of the generated sources and
+# tool versions, and the real ROM contents are patched into the BRAM init values of the
+# cached nextpnr config with ecpbram, which takes seconds instead of a full build.
+
+def rom_placeholder() -> list:
+    # Random words so that ecpbram finds every one of them in the BRAM init values
+    rng = random.Random(0x5779726d)
+    return [rng.getrandbits(32) for _ in range(ROM_SIZE//4)]
+
+def write_hex(path:str, words:list) -> None:
+    with open(path, "w") as f:
+        f.writelines(f"{word:08x}\n" for word in words)
+
+def gateware_key(soc, builder) -> str:
+    """
+    Hash of everything that goes into place and route, comments (timestamps) left out.
+    """
+    digest = hashlib.sha256()
+    sources = [os.path.join(builder.gateware_dir, name) for name in sorted(os.listdir(builder.gateware_dir))
+        if os.path.splitext(name)[1] in (".v", ".sv", ".lpf", ".ys", ".sh", ".init")]
+    sources += [source[0] for source in soc.platform.sources]
+    sources += sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "*.mem")))
+    for source in sources:
+        digest.update(os.path.basename(source).encode())
+        with open(source, errors="replace") as f:
+            for line in f:
+                if not line.lstrip().startswith(("//", "#")):
+                    digest.update(line.encode())
+    for tool in (["yosys", "-V"], ["nextpnr-ecp5", "--version"], ["ecppack", "--version"]):
+        try:
+            digest.update(subprocess.run(tool, capture_output=True).stdout)
+        except OSError:
+            pass
+    return digest.hexdigest()[:16]
+
+def build_cached(soc, builder, rom:str, toolchain_argdict:dict) -> None:
+    """
+    Build with the ROM placeholder unless this gateware is cached already, then patch in rom.
+    """
+    words = get_mem_data(rom, endianness="little")
+    if len(words) > ROM_SIZE//4:
+        raise ValueError(f"{rom} does not fit the {ROM_SIZE} byte ROM")
+
+    # Sources and software only, the toolchain runs below if needed
+    builder.build(run=False, **toolchain_argdict)
+    name = os.path.splitext(os.path.basename(builder.get_bitstream_filename(mode="sram")))[0]
+    gateware_dir = builder.gateware_dir
+    script = os.path.join(gateware_dir, f"build_{name}.sh")
+    cache = os.path.join(builder.output_dir, "cache", gateware_key(soc, builder))
+    cached_config = os.path.join(cache, f"{name}.config")
+    placeholder = os.path.join(cache, "rom_placeholder.hex")
+
+    if os.path.exists(cached_config):
+        print(f"Gateware unchanged, reusing {cache}")
+    else:
+        subprocess.run(["bash", script], cwd=gateware_dir, check=True)
+        os.makedirs(cache, exist_ok=True)
+        write_hex(placeholder, rom_placeholder())
+        shutil.copy(os.path.join(gateware_dir, f"{name}.config"), cached_config)
+
+    rom_hex = os.path.join(gateware_dir, "rom.hex")
+    write_hex(rom_hex, list(words) + [0]*(ROM_SIZE//4 - len(words)))
+    subprocess.run(["ecpbram", "-i", cached_config, "-o", os.path.join(gateware_dir, f"{name}.config"),
+        "-f", placeholder, "-t", rom_hex], check=True)
+    # Pack the bitstream the way the LiteX build script does
+    with open(script) as f:
+        ecppack = [line for line in f if line.startswith("ecppack")]
+    subprocess.run(ecppack[-1], shell=True, cwd=gateware_dir, check=True)
+
 # Build --------------------------------------------------------------------------------------------
 
 def main():
@@ -300,34 +533,53 @@ def main():
     parser = LiteXArgumentParser(platform=colorlight_5a_75b.Platform, description="LiteX SoC on Colorlight 5A-75X.")
     parser.add_target_argument("--revision",          default="8.2",            help="Board revision (6.0, 6.1, 7.0, 8.0, or 8.2).")
     parser.add_target_argument("--sys-clk-freq",      default=50e6, type=float, help="System clock frequency.")
-    ethopts = parser.target_group.add_mutually_exclusive_group()
-    ethopts.add_argument("--with-ethernet",           action="store_true",      help="Enable Ethernet support.")
-    ethopts.add_argument("--with-etherbone",          action="store_true",      help="Enable Etherbone support.")
+    parser.add_target_argument("--with-ethernet",     action="store_true",      help="Enable Ethernet support.")
+    parser.add_target_argument("--with-etherbone",    action="store_true",      help="Enable Etherbone support, next to the firmware's with --with-ethernet.")
     parser.add_target_argument("--eth-ip",            default="192.168.10.30",  help="Ethernet/Etherbone IP address.")
+    parser.add_target_argument("--eth-mac",           default="72:6b:89:5b:c2:e2", help="Ethernet MAC address of the firmware, unique per board.")
+    parser.add_target_argument("--etherbone-ip",      default="192.168.10.50",  help="Etherbone IP address when combined with --with-ethernet.")
     parser.add_target_argument("--eth-phy",           default=0, type=int,      help="Ethernet PHY (0 or 1).")
     parser.add_target_argument("--use-internal-osc",  action="store_true",      help="Use internal oscillator.")
     parser.add_target_argument("--sdram-rate",        default="1:1",            help="SDRAM Rate (1:1 Full Rate or 1:2 Half Rate).")
     parser.add_target_argument("--with-spi-flash",    action="store_true",      help="Add SPI flash support to the SoC")
     parser.add_target_argument("--flash",             action="store_true",      help="Flash the code to the target FPGA")
+    parser.add_target_argument("--board-id",          default=None,             help="With --flash, name of the board being flashed, keys the record of its flash contents (default: --eth-mac).")
+    parser.add_target_argument("--full",              action="store_true",      help="With --flash, rewrite every sector, not only the ones changed since the last flash.")
     parser.add_target_argument("--rom",               default=None,             help="ROM default contents.")
+    parser.add_target_argument("--no-build-cache",    action="store_true",      help="Build the gateware with the ROM baked in, without the build cache.")
+    parser.add_target_argument("--layout",            default=None,             help="Panel wall layout JSON (default: 2x2 panels on j4, j3, j2, j1).")
+    parser.add_target_argument("--double-buffer",     action="store_true",      help="Double buffer the panel memories, frames are shown on commit.")
     args = parser.parse_args()
 
+    # The build cache needs ecpbram (prjtrellis) to patch the ROM into the bitstream
+    build_cache = args.build and args.rom is not None and not args.no_build_cache
+    if build_cache and shutil.which("ecpbram") is None:
+        print("ecpbram not found, building without the build cache")
+        build_cache = False
+
     soc = BaseSoC(revision=args.revision,
         sys_clk_freq     = args.sys_clk_freq,
         toolchain        = args.toolchain,
         with_ethernet    = args.with_ethernet,
         with_etherbone   = args.with_etherbone,
         eth_ip           = args.eth_ip,
+        eth_mac          = args.eth_mac,
+        etherbone_ip     = args.etherbone_ip,
         eth_phy          = args.eth_phy,
         use_internal_osc = args.use_internal_osc,
         sdram_rate       = args.sdram_rate,
         with_spi_flash   = args.with_spi_flash,
         rom              = args.rom,
+        rom_init         = rom_placeholder() if build_cache else None,
+        layout           = PanelLayout.load(args.layout) if args.layout else None,
+        double_buffer    = args.double_buffer,
         **parser.soc_argdict
     )
     builder = Builder(soc, **parser.builder_argdict)
 
-    if args.build:
+    if build_cache:
+        build_cached(soc, builder, args.rom, parser.toolchain_argdict)
+    elif args.build:
         builder.build(**parser.toolchain_argdict)
 
     if args.load:
@@ -336,9 +588,18 @@ def main():
 
     if args.flash:
         prog = soc.platform.create_programmer()
-        os.system("cp bit_to_flash.py build/colorlight_5a_75b/gateware/")
-        os.system("cd build/colorlight_5a_75b/gateware/ && ./bit_to_flash.py colorlight_5a_75b.bit wyrm_flash.svf")
-        prog.load_bitstream("build/colorlight_5a_75b/gateware/wyrm_flash.svf")
+        svf = os.path.join(builder.gateware_dir, "wyrm_flash.svf")
+        # Sector hashes of what is on this board's flash, as of its last successful --flash. Boards of a
+        # wall are built from the same tree, so each one gets its own record.
+        board_id = re.sub(r"[^0-9A-Za-z_.-]", "", args.board_id or args.eth_mac)
+        manifest = os.path.join(builder.gateware_dir, f"wyrm_flash-{board_id}.json")
+        # OpenOCD plays the SVF, it has no LOOP: fixed waits only
+        result = bit_to_svf(builder.get_bitstream_filename(mode="sram"), svf, manifest=None if args.full else manifest)
+        if not args.full and os.path.exists(manifest):
+            print(f"Using {manifest} as the flash contents of board {board_id}")
+        print(f"Flashing {result['sectors']} sectors, skipping {result['unchanged']} unchanged since the last flash")
+        prog.load_bitstream(svf)
+        save_manifest(manifest, result)
 
 if __name__ == "__main__":
     main()